@@ -2,8 +2,104 @@ import json
 import gzip
 import logging
 from datetime import datetime
-from typing import Dict, Any, List, Set
+from typing import Dict, List, Tuple, Callable, NamedTuple
 import os
+import io
+import tempfile
+from array import array
+from bisect import bisect_left
+import threading
+from contextlib import contextmanager
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работаем на стандартном json
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return orjson.dumps(obj)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+try:
+    import simdjson
+except ImportError:  # simdjson необязателен: без него строка разбирается целиком
+    simdjson = None
+
+if simdjson is not None:
+    # Один парсер на процесс: simdjson переиспользует его буферы между строками
+    _FIELDS_PARSER = simdjson.Parser()
+
+    def parse_question_text(line: bytes) -> str:
+        """
+        Достает из строки simplified NQ только question_text
+        Остальная запись (document_text, annotations, ...) в dict не собирается
+        """
+        return _FIELDS_PARSER.parse(line).get('question_text', '')
+else:
+    def parse_question_text(line: bytes) -> str:
+        """Достает из строки simplified NQ только question_text"""
+        return json_loads(line).get('question_text', '')
+
+try:
+    import rapidgzip
+except ImportError:  # rapidgzip необязателен: без него распаковываем стандартным gzip
+    rapidgzip = None
+
+# Размер буфера чтения распакованного потока
+GZIP_READ_BUFFER_SIZE = 128 * 1024
+
+def open_gzip(filepath: str):
+    """
+    Открывает gzip файл на чтение в бинарном режиме
+    При наличии rapidgzip распаковка идет параллельно на всех ядрах,
+    tell()/seek() работают со смещениями в распакованном потоке
+    """
+    if rapidgzip is not None:
+        raw = rapidgzip.open(filepath, parallelization=os.cpu_count())
+    else:
+        raw = gzip.open(filepath, 'rb')
+    return io.BufferedReader(raw, buffer_size=GZIP_READ_BUFFER_SIZE)
+
+# Сколько фрагментов (запись и перевод строки) копится в буфере перед записью на диск
+WRITE_BATCH_SIZE = 2048
+
+def flush_lines(f, lines: List[bytes]):
+    """Записывает накопленные фрагменты одним вызовом write и очищает буфер"""
+    if lines:
+        f.write(b''.join(lines))
+        lines.clear()
+
+# Как часто (в секундах) пишется прогресс обработки
+PROGRESS_INTERVAL = 5.0
+
+@contextmanager
+def progress_reporter(report: Callable[[], None], interval: float = PROGRESS_INTERVAL):
+    """
+    Пока выполняется блок with, фоновый поток раз в interval секунд вызывает report()
+    Так в горячем цикле не остается ни проверок счетчика, ни вызовов logging
+    """
+    stop = threading.Event()
+    
+    def run():
+        while not stop.wait(interval):
+            report()
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
 
 # Настройка логирования
 logging.basicConfig(
@@ -19,30 +115,84 @@ def normalize_question(text: str) -> str:
     """Нормализация текста вопроса"""
     return text.lower().strip()
 
-def load_simplified_nq(filepath: str) -> Dict[str, dict]:
+class SimplifiedNQIndex(NamedTuple):
+    """
+    Индекс Simplified NQ в виде двух параллельных массивов, отсортированных по хешу вопроса
+    Вместо словаря со строками и кортежами на каждый вопрос приходится 16 байт (и 2 байта фильтра)
+    """
+    hashes: array      # array('q'): hash() нормализованного вопроса, по возрастанию
+    offsets: array     # array('Q'): смещение строки в распакованном потоке
+    bloom: bytearray   # фильтр Блума по hashes, см. build_bloom
+
+# Бит фильтра Блума на один вопрос
+BLOOM_BITS_PER_KEY = 16
+
+def build_bloom(hashes: array) -> bytearray:
     """
-    Загружает данные из Simplified NQ датасета
-    Возвращает словарь: нормализованный вопрос -> полные данные
+    Строит фильтр Блума по хешам вопросов
+    Для каждого хеша выставляются два бита: по младшим и по старшим 32 битам
     """
-    questions_dict = {}
+    nbits = 64
+    while nbits < BLOOM_BITS_PER_KEY * len(hashes):
+        nbits <<= 1
+    mask = nbits - 1
+    bloom = bytearray(nbits >> 3)
+    for h in hashes:
+        i, j = h & mask, (h >> 32) & mask
+        bloom[i >> 3] |= 1 << (i & 7)
+        bloom[j >> 3] |= 1 << (j & 7)
+    return bloom
+
+def find_offset(index: SimplifiedNQIndex, normalized_question: str) -> int:
+    """
+    Ищет вопрос в индексе бинарным поиском по хешу
+    Возвращает смещение записи или -1, если вопроса нет
+    """
+    h = hash(normalized_question)
+    # Большинство отсутствующих вопросов отсекается фильтром Блума, без бинарного поиска
+    bloom = index.bloom
+    mask = (len(bloom) << 3) - 1
+    i, j = h & mask, (h >> 32) & mask
+    if not (bloom[i >> 3] >> (i & 7)) & 1 or not (bloom[j >> 3] >> (j & 7)) & 1:
+        return -1
+    
+    i = bisect_left(index.hashes, h)
+    if i < len(index.hashes) and index.hashes[i] == h:
+        return index.offsets[i]
+    return -1
+
+def load_simplified_nq(filepath: str) -> SimplifiedNQIndex:
+    """
+    Загружает индекс Simplified NQ датасета
+    Для каждого вопроса хранится только хеш нормализованного текста и смещение строки,
+    полная запись читается по смещению только для найденных совпадений (см. copy_records_in_offset_order)
+    Хеш hash() действителен только в текущем процессе, поэтому индекс не сохраняется на диск
+    """
+    hashes = array('q')
+    offsets = array('Q')
     total_processed = 0
     
     try:
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
+        line_num = 0
+        with progress_reporter(lambda: logging.info(f"Processed {line_num} lines from simplified NQ dataset")), \
+             open_gzip(filepath) as f:
+            while True:
+                # Запоминаем смещение строки в распакованном потоке
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                line_num += 1
+                
                 try:
-                    data = json.loads(line.strip())
-                    question = data.get('question_text', '').strip()
+                    normalized_question = normalize_question(parse_question_text(line))
                     
-                    if question:
-                        normalized_question = normalize_question(question)
-                        questions_dict[normalized_question] = data
+                    if normalized_question:
+                        hashes.append(hash(normalized_question))
+                        offsets.append(pos)
                         total_processed += 1
-                        
-                        if line_num % 10000 == 0:
-                            logging.info(f"Processed {line_num} lines from simplified NQ dataset")
                 
-                except json.JSONDecodeError:
+                except ValueError:  # ошибки разбора json, orjson и simdjson
                     logging.error(f"Error parsing JSON at line {line_num} in simplified NQ")
                     continue
                 except Exception as e:
@@ -52,45 +202,103 @@ def load_simplified_nq(filepath: str) -> Dict[str, dict]:
     except Exception as e:
         logging.error(f"Error reading file {filepath}: {str(e)}")
     
+    # Сортируем по хешу; сортировка устойчивая, поэтому из повторов вопроса,
+    # как и раньше в словаре, остается последняя запись
+    sorted_hashes = array('q')
+    sorted_offsets = array('Q')
+    for i in sorted(range(len(hashes)), key=hashes.__getitem__):
+        if sorted_hashes and sorted_hashes[-1] == hashes[i]:
+            sorted_offsets[-1] = offsets[i]
+        else:
+            sorted_hashes.append(hashes[i])
+            sorted_offsets.append(offsets[i])
+    
     logging.info(f"Finished loading simplified NQ dataset. Total questions: {total_processed}")
-    return questions_dict
+    return SimplifiedNQIndex(sorted_hashes, sorted_offsets, build_bloom(sorted_hashes))
+
+def copy_records_in_offset_order(f, offsets: List[int], ftmp) -> Dict[int, Tuple[int, int]]:
+    """
+    Копирует строки simplified NQ по смещениям offsets во временный файл ftmp
+    Смещения обходятся по возрастанию, поэтому архив читается за один проход вперед:
+    без rapidgzip каждый переход назад в gzip заново распаковывал бы файл с начала
+    Возвращает: смещение в архиве -> (смещение во ftmp, длина строки)
+    """
+    spans = {}
+    for byte_offset in sorted(set(offsets)):
+        f.seek(byte_offset)
+        line = f.readline()
+        spans[byte_offset] = (ftmp.tell(), len(line))
+        ftmp.write(line)
+    return spans
 
 def process_nq_open(
     input_file: str,
     output_file: str,
     unmatched_file: str,
-    simplified_nq: Dict[str, dict]
+    simplified_nq: SimplifiedNQIndex,
+    simplified_nq_path: str
 ) -> tuple[int, int, List[tuple[str, str]]]:
     """
     Обрабатывает файл из NQ-open датасета
+    Сначала собираются смещения всех найденных вопросов, затем записи simplified NQ
+    читаются одним проходом по архиву, и результат пишется в порядке NQ-open
     Возвращает: (обработано, найдено совпадений, примеры)
     """
     processed = 0
     matches_found = 0
     match_examples = []  # [(nq_open_question, simplified_nq_question)]
+    rows = []  # [(исходная строка, данные, вопрос, нормализованный вопрос, смещение или -1)]
+    out_lines = []
+    unmatched_lines = []
     
-    with open(input_file, 'r', encoding='utf-8') as fin, \
-         open(output_file, 'w', encoding='utf-8') as fout, \
-         open(unmatched_file, 'w', encoding='utf-8') as funmatched:
+    with progress_reporter(lambda: logging.info(f"Processed {processed} questions from NQ-open")), \
+         open(input_file, 'rb') as fin:
         
         for line in fin:
             try:
-                data = json.loads(line.strip())
+                data = json_loads(line)
                 question = data.get('question', '').strip()
-                answer = data.get('answer', [])
                 
-                # Нормализуем вопрос
-                normalized_question = normalize_question(question)
+                # Нормализуем вопрос: он уже без пробелов по краям, остается привести регистр
+                normalized_question = question.lower()
                 
-                # Ищем соответствие в simplified NQ
-                if normalized_question in simplified_nq:
-                    # Получаем данные из simplified NQ
-                    simplified_data = simplified_nq[normalized_question]
-                    
+                # Ищем соответствие в simplified NQ, саму запись пока не читаем
+                byte_offset = find_offset(simplified_nq, normalized_question)
+                rows.append((line, data, question, normalized_question, byte_offset))
+                
+                processed += 1
+                
+            except json.JSONDecodeError:
+                logging.error(f"Error parsing JSON in NQ-open dataset")
+                continue
+            except Exception as e:
+                logging.error(f"Error processing question in NQ-open: {str(e)}")
+                continue
+    
+    with open(output_file, 'wb') as fout, \
+         open(unmatched_file, 'wb') as funmatched, \
+         tempfile.TemporaryFile() as ftmp:
+        
+        # Читаем полные данные из simplified NQ только для совпадений
+        with open_gzip(simplified_nq_path) as fnq:
+            spans = copy_records_in_offset_order(
+                fnq, [row[4] for row in rows if row[4] >= 0], ftmp)
+        
+        for line, data, question, normalized_question, byte_offset in rows:
+            try:
+                simplified_data = None
+                if byte_offset >= 0:
+                    tmp_offset, length = spans[byte_offset]
+                    ftmp.seek(tmp_offset)
+                    simplified_data = json_loads(ftmp.read(length))
+                
+                # Совпадение хеша проверяем по самому вопросу
+                if simplified_data is not None and \
+                        normalize_question(simplified_data.get('question_text', '')) == normalized_question:
                     # Создаем новую запись, объединяя данные
                     merged_data = {
                         'question': question,  # оригинальный вопрос из NQ-open
-                        'answer': answer,      # оригинальный ответ из NQ-open
+                        'answer': data.get('answer', []),  # оригинальный ответ из NQ-open
                         'document_text': simplified_data.get('document_text', ''),
                         'document_url': simplified_data.get('document_url', ''),
                         'annotations': simplified_data.get('annotations', []),
@@ -99,7 +307,10 @@ def process_nq_open(
                     }
                     
                     # Записываем объединенные данные
-                    fout.write(json.dumps(merged_data, ensure_ascii=False) + '\n')
+                    out_lines.append(json_dumps(merged_data))
+                    out_lines.append(b'\n')
+                    if len(out_lines) >= WRITE_BATCH_SIZE:
+                        flush_lines(fout, out_lines)
                     matches_found += 1
                     
                     # Сохраняем пример для отчета
@@ -109,23 +320,20 @@ def process_nq_open(
                             simplified_data.get('question_text', '')
                         ))
                 else:
-                    # Сохраняем ненайденный вопрос
-                    funmatched.write(json.dumps({
-                        'question': question,
-                        'answer': answer
-                    }, ensure_ascii=False) + '\n')
-                
-                processed += 1
-                
-                if processed % 1000 == 0:
-                    logging.info(f"Processed {processed} questions from NQ-open, found matches for {matches_found}")
+                    # Сохраняем ненайденный вопрос: исходная строка уже содержит question и answer
+                    unmatched_lines.append(line if line.endswith(b'\n') else line + b'\n')
+                    if len(unmatched_lines) >= WRITE_BATCH_SIZE:
+                        flush_lines(funmatched, unmatched_lines)
                 
             except json.JSONDecodeError:
-                logging.error(f"Error parsing JSON in NQ-open dataset")
+                logging.error(f"Error parsing JSON in simplified NQ at offset {byte_offset}")
                 continue
             except Exception as e:
                 logging.error(f"Error processing question in NQ-open: {str(e)}")
                 continue
+        
+        flush_lines(fout, out_lines)
+        flush_lines(funmatched, unmatched_lines)
     
     return processed, matches_found, match_examples
 
@@ -147,18 +355,18 @@ def main():
     # Загружаем simplified NQ датасет
     logging.info(f"Loading simplified NQ dataset: {simplified_nq}")
     simplified_nq_data = load_simplified_nq(simplified_nq)
-    logging.info(f"Loaded {len(simplified_nq_data)} questions from simplified NQ dataset")
+    logging.info(f"Loaded {len(simplified_nq_data.hashes)} questions from simplified NQ dataset")
     
     # Обрабатываем train датасет
     logging.info("Processing NQ-open train dataset...")
     train_processed, train_matches, train_examples = process_nq_open(
-        nq_open_train, train_output, train_unmatched, simplified_nq_data
+        nq_open_train, train_output, train_unmatched, simplified_nq_data, simplified_nq
     )
     
     # Обрабатываем dev датасет
     logging.info("Processing NQ-open dev dataset...")
     dev_processed, dev_matches, dev_examples = process_nq_open(
-        nq_open_dev, dev_output, dev_unmatched, simplified_nq_data
+        nq_open_dev, dev_output, dev_unmatched, simplified_nq_data, simplified_nq
     )
     
     # Записываем подробный отчет
@@ -177,7 +385,7 @@ def main():
         
         f.write("Simplified NQ Dataset Statistics\n")
         f.write("-" * 80 + "\n")
-        f.write(f"Total questions loaded: {len(simplified_nq_data)}\n\n")
+        f.write(f"Total questions loaded: {len(simplified_nq_data.hashes)}\n\n")
         
         f.write("NQ-open Train Dataset\n")
         f.write("-" * 80 + "\n")
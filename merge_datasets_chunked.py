@@ -3,9 +3,81 @@ import gzip
 import logging
 from datetime import datetime
 import os
+import io
+import tempfile
 import argparse
 from tqdm import tqdm
 import gc
+from typing import Dict, List, Tuple, Any
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работаем на стандартном json
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return orjson.dumps(obj)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+try:
+    import simdjson
+except ImportError:  # simdjson необязателен: без него строка разбирается целиком
+    simdjson = None
+
+if simdjson is not None:
+    # Один парсер на процесс: simdjson переиспользует его буферы между строками
+    _FIELDS_PARSER = simdjson.Parser()
+
+    def parse_index_fields(line: bytes) -> Tuple[str, Any, str]:
+        """
+        Достает из строки simplified NQ только (question_text, example_id, document_url)
+        Остальная запись (document_text, annotations, ...) в dict не собирается
+        """
+        doc = _FIELDS_PARSER.parse(line)
+        return doc.get('question_text', ''), doc.get('example_id', ''), doc.get('document_url', '')
+else:
+    def parse_index_fields(line: bytes) -> Tuple[str, Any, str]:
+        """Достает из строки simplified NQ только (question_text, example_id, document_url)"""
+        data = json_loads(line)
+        return data.get('question_text', ''), data.get('example_id', ''), data.get('document_url', '')
+
+try:
+    import rapidgzip
+except ImportError:  # rapidgzip необязателен: без него распаковываем стандартным gzip
+    rapidgzip = None
+
+# Размер буфера чтения распакованного потока
+GZIP_READ_BUFFER_SIZE = 128 * 1024
+
+def open_gzip(filepath: str):
+    """
+    Открывает gzip файл на чтение в бинарном режиме
+    При наличии rapidgzip распаковка идет параллельно на всех ядрах,
+    tell()/seek() работают со смещениями в распакованном потоке
+    """
+    if rapidgzip is not None:
+        raw = rapidgzip.open(filepath, parallelization=os.cpu_count())
+    else:
+        raw = gzip.open(filepath, 'rb')
+    return io.BufferedReader(raw, buffer_size=GZIP_READ_BUFFER_SIZE)
+
+# Сколько фрагментов (запись и перевод строки) копится в буфере перед записью на диск
+WRITE_BATCH_SIZE = 2048
+
+def flush_lines(f, lines: List[bytes]):
+    """Записывает накопленные фрагменты одним вызовом write и очищает буфер"""
+    if lines:
+        f.write(b''.join(lines))
+        lines.clear()
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,7 +102,7 @@ def process_chunk(filepath: str, start_pos: int, chunk_size: int) -> tuple[dict,
     next_pos = start_pos
     
     try:
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
+        with open_gzip(filepath) as f:
             f.seek(start_pos)
             
             while processed < chunk_size:
@@ -41,21 +113,20 @@ def process_chunk(filepath: str, start_pos: int, chunk_size: int) -> tuple[dict,
                     break
                     
                 try:
-                    data = json.loads(line.strip())
-                    question = data.get('question_text', '').strip()
+                    question, example_id, document_url = parse_index_fields(line)
+                    normalized_question = normalize_question(question)
                     
-                    if question:
-                        normalized_question = normalize_question(question)
+                    if normalized_question:
                         questions_index[normalized_question] = {
-                            'document_url': data.get('document_url', ''),
-                            'example_id': data.get('example_id', ''),
+                            'document_url': document_url,
+                            'example_id': example_id,
                             'byte_offset': pos
                         }
                     
                     processed += 1
                     next_pos = f.tell()
                 
-                except json.JSONDecodeError:
+                except ValueError:  # ошибки разбора json, orjson и simdjson
                     continue
                 except Exception as e:
                     logging.error(f"Error processing line: {str(e)}")
@@ -67,54 +138,100 @@ def process_chunk(filepath: str, start_pos: int, chunk_size: int) -> tuple[dict,
     
     return questions_index, next_pos
 
-def get_full_data(filepath: str, byte_offset: int) -> dict:
-    """Читает полные данные из определенной позиции в файле"""
-    try:
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
+# Открытые файлы simplified NQ: (путь, NQ-open файл) -> файл
+# У каждого NQ-open файла свой файл: смещения его совпадений от части к части только растут,
+# поэтому чтение идет вперед, без повторной распаковки с начала
+_full_data_files: Dict[Tuple[str, str], io.BufferedReader] = {}
+
+def get_full_data_file(filepath: str, consumer: str) -> io.BufferedReader:
+    """Возвращает открытый simplified NQ файл для NQ-open файла consumer"""
+    f = _full_data_files.get((filepath, consumer))
+    if f is None:
+        f = _full_data_files[(filepath, consumer)] = open_gzip(filepath)
+    return f
+
+def close_full_data_files():
+    """Закрывает файлы, открытые в get_full_data_file"""
+    for f in _full_data_files.values():
+        f.close()
+    _full_data_files.clear()
+
+def copy_records_in_offset_order(f, offsets: List[int], ftmp) -> Dict[int, Tuple[int, int]]:
+    """
+    Копирует строки simplified NQ по смещениям offsets во временный файл ftmp
+    Смещения обходятся по возрастанию, поэтому архив читается за один проход вперед:
+    без rapidgzip каждый переход назад в gzip заново распаковывал бы файл с начала
+    Возвращает: смещение в архиве -> (смещение во ftmp, длина строки)
+    """
+    spans = {}
+    for byte_offset in sorted(set(offsets)):
+        try:
             f.seek(byte_offset)
             line = f.readline()
-            return json.loads(line.strip())
-    except Exception as e:
-        logging.error(f"Error reading data at offset {byte_offset}: {str(e)}")
-        return {}
+        except Exception as e:
+            logging.error(f"Error reading data at offset {byte_offset}: {str(e)}")
+            continue
+        spans[byte_offset] = (ftmp.tell(), len(line))
+        ftmp.write(line)
+    return spans
 
 def process_nq_open_chunk(input_file: str, output_file: str, unmatched_file: str,
                          questions_index: dict, simplified_nq_path: str,
-                         start_line: int, chunk_size: int) -> tuple[int, int, int]:
-    """Обрабатывает часть NQ-open датасета"""
+                         chunk_size: int) -> tuple[int, int]:
+    """
+    Обрабатывает первые chunk_size вопросов NQ-open датасета с индексом текущей части simplified NQ
+    Записи simplified NQ для совпадений читаются после разбора вопросов, по возрастанию смещений
+    Возвращает: (обработано, найдено совпадений)
+    """
     processed = matches = 0
-    next_line = start_line
+    rows = []  # [(исходная строка, данные, вопрос, данные индекса или None)]
+    out_lines = []
+    unmatched_lines = []
     
     try:
-        with open(input_file, 'r', encoding='utf-8') as fin, \
-             open(output_file, 'a', encoding='utf-8') as fout, \
-             open(unmatched_file, 'a', encoding='utf-8') as funmatched:
+        with open(input_file, 'rb') as fin, \
+             open(output_file, 'ab') as fout, \
+             open(unmatched_file, 'ab') as funmatched, \
+             tempfile.TemporaryFile() as ftmp:
+            
+            while len(rows) < chunk_size:
+                line = fin.readline()
+                if not line:
+                    break
+                
+                try:
+                    data = json_loads(line)
+                    question = data.get('question', '').strip()
+                    # Вопрос уже без пробелов по краям, остается привести регистр
+                    rows.append((line, data, question, questions_index.get(question.lower())))
+                except Exception as e:
+                    logging.error(f"Error processing question: {str(e)}")
+                    continue
             
-            # Пропускаем обработанные строки
-            for _ in range(start_line):
-                next(fin)
+            # Читаем полные данные из simplified NQ только для совпадений
+            spans = copy_records_in_offset_order(
+                get_full_data_file(simplified_nq_path, input_file),
+                [row[3]['byte_offset'] for row in rows if row[3] is not None], ftmp)
             
-            pbar = tqdm(total=chunk_size, desc=f"Processing chunk from line {start_line}", 
+            pbar = tqdm(total=chunk_size, desc="Processing NQ-open chunk",
                        unit=" questions")
             
-            for line in fin:
-                if processed >= chunk_size:
-                    break
-                    
+            for line, data, question, index_data in rows:
                 try:
-                    data = json.loads(line.strip())
-                    question = data.get('question', '').strip()
-                    answer = data.get('answer', [])
-                    normalized_question = normalize_question(question)
-                    
-                    if normalized_question in questions_index:
-                        index_data = questions_index[normalized_question]
-                        simplified_data = get_full_data(simplified_nq_path, index_data['byte_offset'])
+                    if index_data is not None:
+                        simplified_data = {}
+                        span = spans.get(index_data['byte_offset'])
+                        if span is not None:
+                            ftmp.seek(span[0])
+                            try:
+                                simplified_data = json_loads(ftmp.read(span[1]))
+                            except Exception as e:
+                                logging.error(f"Error reading data at offset {index_data['byte_offset']}: {str(e)}")
                         
                         if simplified_data:
                             merged_data = {
                                 'question': question,
-                                'answer': answer,
+                                'answer': data.get('answer', []),
                                 'document_text': simplified_data.get('document_text', ''),
                                 'document_url': index_data['document_url'],
                                 'annotations': simplified_data.get('annotations', []),
@@ -122,16 +239,18 @@ def process_nq_open_chunk(input_file: str, output_file: str, unmatched_file: str
                                 'example_id': index_data['example_id']
                             }
                             
-                            fout.write(json.dumps(merged_data, ensure_ascii=False) + '\n')
+                            out_lines.append(json_dumps(merged_data))
+                            out_lines.append(b'\n')
+                            if len(out_lines) >= WRITE_BATCH_SIZE:
+                                flush_lines(fout, out_lines)
                             matches += 1
                     else:
-                        funmatched.write(json.dumps({
-                            'question': question,
-                            'answer': answer
-                        }, ensure_ascii=False) + '\n')
+                        # Исходная строка уже содержит question и answer, пишем ее как есть
+                        unmatched_lines.append(line if line.endswith(b'\n') else line + b'\n')
+                        if len(unmatched_lines) >= WRITE_BATCH_SIZE:
+                            flush_lines(funmatched, unmatched_lines)
                     
                     processed += 1
-                    next_line += 1
                     pbar.update(1)
                     pbar.set_postfix({
                         'matches': f"{matches}/{processed}",
@@ -140,15 +259,16 @@ def process_nq_open_chunk(input_file: str, output_file: str, unmatched_file: str
                 
                 except Exception as e:
                     logging.error(f"Error processing question: {str(e)}")
-                    next_line += 1
                     continue
             
+            flush_lines(fout, out_lines)
+            flush_lines(funmatched, unmatched_lines)
             pbar.close()
     
     except Exception as e:
         logging.error(f"Error processing file {input_file}: {str(e)}")
     
-    return processed, matches, next_line
+    return processed, matches
 
 def main():
     parser = argparse.ArgumentParser(description='Process NQ-open dataset')
@@ -181,43 +301,46 @@ def main():
     chunk_start = 0
     total_processed = total_matches = 0
     
-    while True:
-        # Создаем индекс для текущего чанка
-        logging.info(f"Processing chunk starting at position {chunk_start}")
-        questions_index, next_chunk = process_chunk(simplified_nq, chunk_start, args.chunk_size)
-        
-        if not questions_index or next_chunk == -1:
-            break
+    try:
+        while True:
+            # Создаем индекс для текущего чанка
+            logging.info(f"Processing chunk starting at position {chunk_start}")
+            questions_index, next_chunk = process_chunk(simplified_nq, chunk_start, args.chunk_size)
+            
+            if not questions_index or next_chunk == -1:
+                break
+            
+            logging.info(f"Created index for {len(questions_index)} questions in current chunk")
+            
+            # Обрабатываем датасеты с текущим индексом
+            if args.dataset in ['train', 'both']:
+                processed, matches = process_nq_open_chunk(
+                    nq_open_train, train_output, train_unmatched,
+                    questions_index, simplified_nq, args.chunk_size
+                )
+                total_processed += processed
+                total_matches += matches
+                logging.info(f"Chunk processed {processed} questions, found {matches} matches")
+            
+            if args.dataset in ['dev', 'both']:
+                processed, matches = process_nq_open_chunk(
+                    nq_open_dev, dev_output, dev_unmatched,
+                    questions_index, simplified_nq, args.chunk_size
+                )
+                total_processed += processed
+                total_matches += matches
+                logging.info(f"Chunk processed {processed} questions, found {matches} matches")
+            
+            # Очищаем память
+            questions_index.clear()
+            gc.collect()
             
-        logging.info(f"Created index for {len(questions_index)} questions in current chunk")
-        
-        # Обрабатываем датасеты с текущим индексом
-        if args.dataset in ['train', 'both']:
-            processed, matches, _ = process_nq_open_chunk(
-                nq_open_train, train_output, train_unmatched,
-                questions_index, simplified_nq, 0, args.chunk_size
-            )
-            total_processed += processed
-            total_matches += matches
-            logging.info(f"Chunk processed {processed} questions, found {matches} matches")
-        
-        if args.dataset in ['dev', 'both']:
-            processed, matches, _ = process_nq_open_chunk(
-                nq_open_dev, dev_output, dev_unmatched,
-                questions_index, simplified_nq, 0, args.chunk_size
-            )
-            total_processed += processed
-            total_matches += matches
-            logging.info(f"Chunk processed {processed} questions, found {matches} matches")
-        
-        # Очищаем память
-        questions_index.clear()
-        gc.collect()
-        
-        # Переходим к следующему чанку
-        chunk_start = next_chunk
-        if next_chunk == -1:
-            break
+            # Переходим к следующему чанку
+            chunk_start = next_chunk
+            if next_chunk == -1:
+                break
+    finally:
+        close_full_data_files()
     
     end_time = datetime.now()
     logging.info(f"Processing completed in {end_time - start_time}")
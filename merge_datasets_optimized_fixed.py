@@ -1,10 +1,216 @@
 import json
 import gzip
+import re
 import logging
 from datetime import datetime
-from typing import Dict, Any, List, Set
+from typing import Dict, Any, List, Set, Tuple, NamedTuple, Optional
 import os
+import io
+import tempfile
 import argparse
+import queue
+import threading
+import pickle
+import hashlib
+from array import array
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работаем на стандартном json
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return orjson.dumps(obj)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+# Значение поля сразу после ключа: строка JSON или целое число
+_FIELD_VALUE_RE = re.compile(rb'\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+def find_field_value(line: bytes, key: bytes):
+    """
+    Ищет в сырой строке JSON значение поля верхнего уровня, не разбирая остальную запись
+    Ключ в кавычках не может встретиться внутри строкового значения: там кавычки экранированы
+    Поиск идет с конца строки: в simplified NQ нужные поля стоят после document_text
+    Возвращает сырые байты значения или None
+    """
+    i = line.rfind(key)
+    if i < 0:
+        return None
+    m = _FIELD_VALUE_RE.match(line, i + len(key))
+    return m.group(1) if m else None
+
+def parse_index_fields(line: bytes) -> Tuple[str, Any, str]:
+    """
+    Достает из строки simplified NQ (question_text, example_id, document_url)
+    Разбираются только найденные значения, а не огромные document_text и annotations;
+    если какого-то поля нет, строка разбирается целиком
+    """
+    question = find_field_value(line, b'"question_text"')
+    example_id = find_field_value(line, b'"example_id"')
+    document_url = find_field_value(line, b'"document_url"')
+    if question is None or example_id is None or document_url is None:
+        data = json_loads(line)
+        return data.get('question_text', ''), data.get('example_id', ''), data.get('document_url', '')
+    return json_loads(question), json_loads(example_id), json_loads(document_url)
+
+try:
+    import rapidgzip
+except ImportError:  # rapidgzip необязателен: без него распаковываем через isal или стандартный gzip
+    rapidgzip = None
+
+try:
+    from isal import igzip
+except ImportError:  # python-isal необязателен: без него распаковываем стандартным gzip
+    igzip = None
+
+# Размер буфера чтения распакованного потока
+GZIP_READ_BUFFER_SIZE = 128 * 1024
+
+# Индекс точек доступа rapidgzip сохраняется рядом с архивом: <архив>.gzindex,
+# а размер и mtime архива, для которого он построен, - в <архив>.gzindex.json
+GZIP_INDEX_SUFFIX = '.gzindex'
+GZIP_INDEX_META_SUFFIX = '.gzindex.json'
+
+def gzip_signature(filepath: str) -> List[int]:
+    """Отпечаток архива: [размер, mtime в наносекундах]"""
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def gzip_index_is_valid(filepath: str) -> bool:
+    """
+    Проверяет, что сохраненный индекс построен для этого архива
+    Сравнение только mtime пропустит архив, замененный с сохранением mtime (cp -p, rsync)
+    """
+    try:
+        if not os.path.exists(filepath + GZIP_INDEX_SUFFIX):
+            return False
+        with open(filepath + GZIP_INDEX_META_SUFFIX, 'r', encoding='utf-8') as f:
+            return json.load(f) == gzip_signature(filepath)
+    except (OSError, ValueError):
+        return False
+
+def open_gzip(filepath: str):
+    """
+    Открывает gzip файл на чтение в бинарном режиме
+    При наличии rapidgzip распаковка идет параллельно на всех ядрах, а seek() использует
+    сохраненный индекс точек доступа (см. export_gzip_index); иначе используется python-isal
+    (ISA-L inflate), если он установлен. tell()/seek() во всех случаях работают одинаково
+    """
+    if rapidgzip is not None:
+        raw = rapidgzip.open(filepath, parallelization=os.cpu_count())
+        if gzip_index_is_valid(filepath):
+            raw.import_index(filepath + GZIP_INDEX_SUFFIX)
+    elif igzip is not None:
+        raw = igzip.open(filepath, 'rb')
+    else:
+        raw = gzip.open(filepath, 'rb')
+    return io.BufferedReader(raw, buffer_size=GZIP_READ_BUFFER_SIZE)
+
+def export_gzip_index(f, filepath: str):
+    """
+    Сохраняет индекс точек доступа rapidgzip после полного прохода по файлу,
+    чтобы последующие seek() и следующие запуски не распаковывали архив заново
+    """
+    if rapidgzip is None:
+        return
+    meta_path = filepath + GZIP_INDEX_META_SUFFIX
+    try:
+        # Отпечаток пишется после индекса: недописанный индекс не будет принят за годный
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        f.raw.export_index(filepath + GZIP_INDEX_SUFFIX)
+        with open(meta_path, 'w', encoding='utf-8') as fmeta:
+            json.dump(gzip_signature(filepath), fmeta)
+    except Exception as e:
+        logging.warning(f"Could not save gzip index for {filepath}: {str(e)}")
+
+# Строки simplified NQ передаются из потока чтения пачками по READ_BATCH_SIZE,
+# в очереди ждет не больше READ_QUEUE_SIZE пачек
+READ_BATCH_SIZE = 1000
+READ_QUEUE_SIZE = 10
+# Как часто (в секундах) поток чтения проверяет, не остановлено ли чтение
+READ_PUT_TIMEOUT = 0.1
+
+def read_line_batches(filepath: str):
+    """
+    Читает gzip файл в отдельном потоке и отдает пачки [(смещение, строка), ...]
+    zlib и rapidgzip отпускают GIL во время распаковки, поэтому распаковка следующих строк
+    идет одновременно с разбором текущих в основном потоке. Сам разбор остается в основном
+    потоке: orjson и re держат GIL, и дополнительные потоки разбора его не ускорят
+    Ошибка чтения пробрасывается в вызывающий код; если вызывающий код прекратил чтение,
+    поток чтения останавливается и закрывает архив
+    """
+    batches = queue.Queue(maxsize=READ_QUEUE_SIZE)
+    stop = threading.Event()
+    
+    def put(item) -> bool:
+        """Кладет пачку в очередь; False, если чтение остановлено"""
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=READ_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def read():
+        try:
+            with open_gzip(filepath) as f:
+                pos = 0
+                batch = []
+                for line in f:
+                    batch.append((pos, line))
+                    pos += len(line)
+                    if len(batch) >= READ_BATCH_SIZE:
+                        if not put(batch):
+                            return
+                        batch = []
+                if batch and not put(batch):
+                    return
+                export_gzip_index(f, filepath)
+            put(None)
+        except Exception as e:
+            put(e)
+    
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+        thread.join()
+
+def flush_lines(f, lines: List[bytes]):
+    """Записывает накопленные фрагменты одним вызовом write и очищает буфер"""
+    if lines:
+        f.write(b''.join(lines))
+        lines.clear()
+
+# Хвосты записей unmatched после поля answer: у поля error всего два значения
+UNMATCHED_NO_MATCH_TAIL = b',"error":"No match found"}\n'
+UNMATCHED_NO_DATA_TAIL = b',"error":"Failed to get full data"}\n'
+
+def unmatched_record(question: str, answer: Any, tail: bytes) -> bytes:
+    """
+    Собирает строку unmatched по шаблону {"question": ..., "answer": ..., "error": ...}
+    Схема записи фиксирована, поэтому через сериализатор проходят только question и answer
+    """
+    return b'{"question":' + json_dumps(question) + b',"answer":' + json_dumps(answer) + tail
 
 # Настройка логирования
 logging.basicConfig(
@@ -16,34 +222,78 @@ logging.basicConfig(
     ]
 )
 
-def normalize_question(text: str) -> str:
-    """Нормализация текста вопроса"""
-    return text.lower().strip()
+def load_needed_questions(input_files: List[str]) -> set:
+    """
+    Собирает нормализованные вопросы из файлов NQ-open
+    Файлы небольшие, так что множество занимает считанные мегабайты
+    """
+    needed = set()
+    for input_file in input_files:
+        try:
+            with open(input_file, 'rb') as fin:
+                for line in fin:
+                    try:
+                        # Нормализация та же, что и при поиске в process_batch
+                        needed.add(json_loads(line).get('question', '').strip().lower())
+                    except ValueError:
+                        continue
+        except Exception as e:
+            logging.error(f"Error reading file {input_file}: {str(e)}")
+    
+    logging.info(f"Collected {len(needed)} questions from NQ-open")
+    return needed
+
+class MinimalIndex(NamedTuple):
+    """
+    Минимальный индекс Simplified NQ в виде параллельных массивов (строка i - один вопрос)
+    Вместо отдельного dict на каждый вопрос хранятся только номер строки и элементы массивов
+    """
+    rows: Dict[str, int]          # нормализованный вопрос -> номер строки
+    offsets: array                # array('q'): смещение записи в распакованном потоке
+    document_urls: List[str]
+    example_ids: List[Any]
+    original_questions: List[str]  # оригинальный вопрос для отладки
 
-def load_simplified_nq_minimal(filepath: str) -> Dict[str, Dict[str, Any]]:
+def load_simplified_nq_minimal(filepath: str, needed: Set[str]) -> Tuple[MinimalIndex, bool]:
     """
     Загружает минимально необходимые данные из Simplified NQ датасета
-    Возвращает словарь: нормализованный вопрос -> {document_url, example_id, original_question}
+    В индекс попадают только вопросы из needed: остальные при поиске не понадобятся
+    offsets - смещения строк в распакованном потоке, по ним полная запись читается сразу (см. copy_records_in_offset_order)
+    Возвращает: (индекс, прочитан ли архив целиком); неполный индекс нельзя сохранять
     """
-    questions_dict = {}
+    index = MinimalIndex({}, array('q'), [], [], [])
     total_processed = 0
+    complete = True
     
     try:
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
+        # Бинарный режим: смещения строк - настоящие смещения в распакованном потоке
+        line_num = 0
+        for batch in read_line_batches(filepath):
+            for pos, line in batch:
+                line_num += 1
+                
                 try:
-                    data = json.loads(line.strip())
                     # Используем правильное поле question_text
-                    question = data.get('question_text', '').strip()
+                    question, example_id, document_url = parse_index_fields(line)
+                    question = question.strip()
                     
                     if question:
-                        normalized_question = normalize_question(question)
-                        # Сохраняем только необходимые поля и оригинальный вопрос
-                        questions_dict[normalized_question] = {
-                            'document_url': data.get('document_url', ''),
-                            'example_id': data.get('example_id', ''),
-                            'original_question': question  # сохраняем оригинальный вопрос для отладки
-                        }
+                        normalized_question = question.lower()
+                        if normalized_question in needed:
+                            # Сохраняем только необходимые поля и оригинальный вопрос;
+                            # повторный вопрос перезаписывает свою строку
+                            row = index.rows.get(normalized_question)
+                            if row is None:
+                                index.rows[normalized_question] = len(index.offsets)
+                                index.offsets.append(pos)
+                                index.document_urls.append(document_url)
+                                index.example_ids.append(example_id)
+                                index.original_questions.append(question)
+                            else:
+                                index.offsets[row] = pos
+                                index.document_urls[row] = document_url
+                                index.example_ids[row] = example_id
+                                index.original_questions[row] = question
                         total_processed += 1
                         
                         if line_num % 10000 == 0:
@@ -52,98 +302,183 @@ def load_simplified_nq_minimal(filepath: str) -> Dict[str, Dict[str, Any]]:
                             if line_num == 10000:
                                 logging.info(f"Example normalized question: '{normalized_question}'")
                 
-                except json.JSONDecodeError:
-                    logging.error(f"Error parsing JSON at line {line_num} in simplified NQ")
+                except ValueError:  # ошибки разбора json и orjson
+                    logging.error("Error parsing JSON at line %d in simplified NQ", line_num)
                     continue
-                except Exception as e:
-                    logging.error(f"Error processing line {line_num} in simplified NQ: {str(e)}")
+                except (AttributeError, TypeError) as e:  # поле неожиданного типа
+                    logging.error("Error processing line %d in simplified NQ: %s", line_num, e)
                     continue
     
     except Exception as e:
         logging.error(f"Error reading file {filepath}: {str(e)}")
+        complete = False
     
     logging.info(f"Finished loading simplified NQ dataset. Total questions: {total_processed}")
-    return questions_dict
+    return index, complete
+
+
+# Готовый минимальный индекс сохраняется рядом с архивом: <архив>.minimal_index.pkl
+MINIMAL_INDEX_SUFFIX = '.minimal_index.pkl'
+MINIMAL_INDEX_VERSION = 1
 
-def get_full_data_from_simplified_nq(filepath: str, target_question: str) -> Dict[str, Any]:
+def needed_questions_key(needed: Set[str]) -> str:
+    """Отпечаток множества вопросов, под которое построен индекс"""
+    digest = hashlib.sha1()
+    for question in sorted(needed):
+        digest.update(question.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def load_cached_minimal_index(filepath: str, needed: Set[str]) -> Optional[MinimalIndex]:
     """
-    Ищет полные данные для конкретного вопроса в Simplified NQ
+    Загружает сохраненный минимальный индекс, если он новее архива
+    и построен под тот же набор вопросов; иначе возвращает None
     """
-    normalized_target = normalize_question(target_question)
-    
+    index_path = filepath + MINIMAL_INDEX_SUFFIX
     try:
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line.strip())
-                    # Используем правильное поле question_text
-                    question = data.get('question_text', '').strip()
-                    
-                    if question and normalize_question(question) == normalized_target:
-                        return data
-                
-                except (json.JSONDecodeError, Exception):
-                    continue
-    
-    except Exception:
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(filepath):
+            return None
+        with open(index_path, 'rb') as f:
+            version, key, fields = pickle.load(f)
+        if version != MINIMAL_INDEX_VERSION or key != needed_questions_key(needed):
+            return None
+        return MinimalIndex(*fields)
+    except Exception as e:
+        logging.warning(f"Could not load cached index {index_path}: {str(e)}")
+        return None
+
+def save_minimal_index(index: MinimalIndex, filepath: str, needed: Set[str]):
+    """
+    Сохраняет минимальный индекс, чтобы следующий запуск не распаковывал архив ради индекса
+    Индекс пишется во временный файл и переименовывается: прерванная запись не оставит обрывок
+    """
+    index_path = filepath + MINIMAL_INDEX_SUFFIX
+    tmp_path = index_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((MINIMAL_INDEX_VERSION, needed_questions_key(needed), tuple(index)),
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+    except Exception as e:
+        logging.warning(f"Could not save index {index_path}: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def copy_records_in_offset_order(f, offsets: List[int], ftmp) -> Dict[int, Tuple[int, int]]:
+    """
+    Копирует строки simplified NQ по смещениям offsets во временный файл ftmp
+    Смещения обходятся по возрастанию, поэтому архив читается за один проход вперед:
+    без rapidgzip каждый переход назад в gzip заново распаковывал бы файл с начала
+    Возвращает: смещение в архиве -> (смещение во ftmp, длина строки)
+    """
+    spans = {}
+    for byte_offset in sorted(set(offsets)):
+        try:
+            f.seek(byte_offset)
+            line = f.readline()
+        except Exception as e:
+            logging.error(f"Error reading data at offset {byte_offset}: {str(e)}")
+            continue
+        spans[byte_offset] = (ftmp.tell(), len(line))
+        ftmp.write(line)
+    return spans
+
+def get_full_data(ftmp, spans: Dict[int, Tuple[int, int]], byte_offset: int) -> Dict[str, Any]:
+    """
+    Читает полные данные вопроса, скопированные из Simplified NQ во временный файл
+    """
+    span = spans.get(byte_offset)
+    if span is None:
+        return {}
+    try:
+        ftmp.seek(span[0])
+        return json_loads(ftmp.read(span[1]))
+    except Exception as e:
+        logging.error(f"Error reading data at offset {byte_offset}: {str(e)}")
+        return {}
+
+def parse_json_lines(lines: List[bytes]) -> List[Any]:
+    """
+    Разбирает строки JSONL одним вызовом парсера: строки склеиваются в JSON массив
+    Пустые строки пропускаются. Если в пачке есть битая строка или число записей не совпало
+    с числом строк (строка вида {...},{...}), пачка разбирается построчно, битые строки пропускаются
+    """
+    lines = [line for line in lines if line.strip()]
+    try:
+        records = json_loads(b'[' + b','.join(lines) + b']')
+        if len(records) == len(lines):
+            return records
+    except ValueError:
         pass
     
-    return {}
+    records = []
+    for line in lines:
+        try:
+            records.append(json_loads(line))
+        except ValueError as e:
+            logging.error("Error processing question in NQ-open: %s", e)
+    return records
 
 def process_nq_open_batch(
     input_file: str,
     output_file: str,
     unmatched_file: str,
-    simplified_nq_minimal: Dict[str, dict],
+    simplified_nq_minimal: MinimalIndex,
     simplified_nq_path: str,
     batch_size: int = 1000
 ) -> tuple[int, int]:
     """
     Обрабатывает файл из NQ-open датасета батчами
+    Сначала разбираются все батчи и собираются смещения совпадений, затем записи simplified NQ
+    копируются во временный файл одним проходом по архиву, и батчи пишутся в порядке NQ-open
     Возвращает: (обработано, найдено совпадений)
     """
     processed = 0
     matches_found = 0
-    current_batch = []
+    batches = []
+    current_lines = []
     
-    with open(input_file, 'r', encoding='utf-8') as fin, \
-         open(output_file, 'w', encoding='utf-8') as fout, \
-         open(unmatched_file, 'w', encoding='utf-8') as funmatched:
-        
+    with open(input_file, 'rb') as fin:
         for line in fin:
+            current_lines.append(line)
+            if len(current_lines) >= batch_size:
+                batches.append(parse_json_lines(current_lines))
+                current_lines = []
+        # Оставшийся батч
+        if current_lines:
+            batches.append(parse_json_lines(current_lines))
+    
+    # Смещения записей simplified NQ для всех найденных вопросов
+    find_row = simplified_nq_minimal.rows.get
+    offsets = []
+    for batch in batches:
+        for data in batch:
             try:
-                data = json.loads(line.strip())
-                current_batch.append(data)
-                
-                # Обрабатываем батч
-                if len(current_batch) >= batch_size:
-                    batch_processed, batch_matches = process_batch(
-                        current_batch,
-                        fout,
-                        funmatched,
-                        simplified_nq_minimal,
-                        simplified_nq_path
-                    )
-                    processed += batch_processed
-                    matches_found += batch_matches
-                    current_batch = []
-                    logging.info(f"Processed {processed} questions, found matches for {matches_found}")
-            
-            except (json.JSONDecodeError, Exception) as e:
-                logging.error(f"Error processing question in NQ-open: {str(e)}")
+                row = find_row(data.get('question', '').strip().lower())
+            except (AttributeError, TypeError):  # запись или поле неожиданного типа
                 continue
+            if row is not None:
+                offsets.append(simplified_nq_minimal.offsets[row])
+    
+    with open(output_file, 'wb') as fout, \
+         open(unmatched_file, 'wb') as funmatched, \
+         tempfile.TemporaryFile() as ftmp:
+        
+        with open_gzip(simplified_nq_path) as fnq:
+            spans = copy_records_in_offset_order(fnq, offsets, ftmp)
         
-        # Обрабатываем оставшийся батч
-        if current_batch:
+        for batch in batches:
             batch_processed, batch_matches = process_batch(
-                current_batch,
+                batch,
                 fout,
                 funmatched,
                 simplified_nq_minimal,
-                simplified_nq_path
+                ftmp,
+                spans
             )
             processed += batch_processed
             matches_found += batch_matches
+            logging.info(f"Processed {processed} questions, found matches for {matches_found}")
     
     return processed, matches_found
 
@@ -151,29 +486,42 @@ def process_batch(
     batch: List[dict],
     fout,
     funmatched,
-    simplified_nq_minimal: Dict[str, dict],
-    simplified_nq_path: str
+    simplified_nq_minimal: MinimalIndex,
+    ftmp,
+    spans: Dict[int, Tuple[int, int]]
 ) -> tuple[int, int]:
-    """Обрабатывает один батч данных"""
+    """
+    Обрабатывает один батч данных, результаты батча записываются разом в конце
+    Полные записи читаются из ftmp (см. copy_records_in_offset_order)
+    """
     processed = 0
     matches_found = 0
+    out_lines = []
+    unmatched_lines = []
+    # Методы и поля, нужные на каждой строке, достаем один раз на батч
+    find_row = simplified_nq_minimal.rows.get
+    offsets = simplified_nq_minimal.offsets
+    add_out = out_lines.append
+    add_unmatched = unmatched_lines.append
     
     for data in batch:
         try:
             # В NQ-open используется поле 'question'
             question = data.get('question', '').strip()
             answer = data.get('answer', [])
-            normalized_question = normalize_question(question)
+            # Вопрос уже без пробелов по краям, остается привести регистр
+            normalized_question = question.lower()
             
             # Для отладки
             if processed < 5:
                 logging.debug(f"Processing question: '{question}'")
                 logging.debug(f"Normalized question: '{normalized_question}'")
             
-            # Проверяем наличие вопроса в минимальном словаре
-            if normalized_question in simplified_nq_minimal:
+            # Проверяем наличие вопроса в минимальном словаре (один поиск в словаре)
+            row = find_row(normalized_question)
+            if row is not None:
                 # Получаем полные данные только для найденных совпадений
-                simplified_data = get_full_data_from_simplified_nq(simplified_nq_path, question)
+                simplified_data = get_full_data(ftmp, spans, offsets[row])
                 
                 if simplified_data:
                     # Создаем новую запись, объединяя данные
@@ -188,37 +536,32 @@ def process_batch(
                     }
                     
                     # Записываем объединенные данные
-                    fout.write(json.dumps(merged_data, ensure_ascii=False) + '\n')
+                    add_out(json_dumps(merged_data))
+                    add_out(b'\n')
                     matches_found += 1
                 else:
                     # Если почему-то не удалось получить полные данные
-                    funmatched.write(json.dumps({
-                        'question': question,
-                        'answer': answer,
-                        'error': 'Failed to get full data'
-                    }, ensure_ascii=False) + '\n')
+                    add_unmatched(unmatched_record(question, answer, UNMATCHED_NO_DATA_TAIL))
             else:
                 # Сохраняем ненайденный вопрос
-                funmatched.write(json.dumps({
-                    'question': question,
-                    'answer': answer,
-                    'error': 'No match found'
-                }, ensure_ascii=False) + '\n')
+                add_unmatched(unmatched_record(question, answer, UNMATCHED_NO_MATCH_TAIL))
             
             processed += 1
             
             # Для отладки первых нескольких вопросов
             if processed <= 5:
-                if normalized_question in simplified_nq_minimal:
+                if row is not None:
                     logging.info(f"Match found for question: '{question}'")
-                    logging.info(f"Simplified NQ question: '{simplified_nq_minimal[normalized_question]['original_question']}'")
+                    logging.info(f"Simplified NQ question: '{simplified_nq_minimal.original_questions[row]}'")
                 else:
                     logging.info(f"No match found for question: '{question}'")
         
-        except Exception as e:
-            logging.error(f"Error processing question: {str(e)}")
+        except (AttributeError, TypeError, ValueError) as e:  # запись или поле неожиданного типа
+            logging.error("Error processing question: %s", e)
             continue
     
+    flush_lines(fout, out_lines)
+    flush_lines(funmatched, unmatched_lines)
     return processed, matches_found
 
 def main():
@@ -248,16 +591,33 @@ def main():
     train_unmatched = 'nq_open/unmatched_questions_train.jsonl'
     dev_unmatched = 'nq_open/unmatched_questions_dev.jsonl'
     
+    # Сначала собираем вопросы NQ-open: в словарь попадут только они
+    needed_files = []
+    if args.dataset in ['train', 'both']:
+        needed_files.append(nq_open_train)
+    if args.dataset in ['dev', 'both']:
+        needed_files.append(nq_open_dev)
+    needed = load_needed_questions(needed_files)
+    
     # Загружаем минимальный словарь из simplified NQ
-    logging.info(f"Loading minimal data from simplified NQ dataset: {simplified_nq}")
-    simplified_nq_minimal = load_simplified_nq_minimal(simplified_nq)
-    logging.info(f"Loaded {len(simplified_nq_minimal)} questions from simplified NQ dataset")
+    simplified_nq_minimal = load_cached_minimal_index(simplified_nq, needed)
+    if simplified_nq_minimal is not None:
+        logging.info(f"Loaded cached index for {simplified_nq}")
+    else:
+        logging.info(f"Loading minimal data from simplified NQ dataset: {simplified_nq}")
+        simplified_nq_minimal, complete = load_simplified_nq_minimal(simplified_nq, needed)
+        # Сохраняем только индекс, построенный по всему архиву
+        if complete:
+            save_minimal_index(simplified_nq_minimal, simplified_nq, needed)
+        else:
+            logging.warning("Simplified NQ was not read completely, index is not cached")
+    logging.info(f"Loaded {len(simplified_nq_minimal.rows)} questions from simplified NQ dataset")
     
     # Выводим несколько примеров вопросов для отладки
-    sample_questions = list(simplified_nq_minimal.items())[:5]
+    sample_questions = list(simplified_nq_minimal.rows.items())[:5]
     logging.info("Sample questions from simplified NQ:")
-    for norm_q, data in sample_questions:
-        logging.info(f"Normalized: '{norm_q}' -> Original: '{data['original_question']}'")
+    for norm_q, row in sample_questions:
+        logging.info(f"Normalized: '{norm_q}' -> Original: '{simplified_nq_minimal.original_questions[row]}'")
     
     train_processed = train_matches = dev_processed = dev_matches = 0
     
@@ -292,7 +652,7 @@ def main():
         
         f.write("Simplified NQ Dataset Statistics\n")
         f.write("-" * 80 + "\n")
-        f.write(f"Total questions loaded: {len(simplified_nq_minimal)}\n\n")
+        f.write(f"Total questions loaded: {len(simplified_nq_minimal.rows)}\n\n")
         
         if args.dataset in ['train', 'both']:
             f.write("NQ-open Train Dataset\n")
@@ -1,10 +1,164 @@
 import json
 import gzip
+import re
 import logging
 from datetime import datetime
 import os
+import io
 import argparse
+import gc
+import mmap
+import multiprocessing
 from tqdm import tqdm
+from typing import List, Tuple, Any, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работаем на стандартном json
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return orjson.dumps(obj)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+# Значение поля сразу после ключа: строка JSON или целое число
+_FIELD_VALUE_RE = re.compile(rb'\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+def find_field_value(line: bytes, key: bytes):
+    """
+    Ищет в сырой строке JSON значение поля верхнего уровня, не разбирая остальную запись
+    Ключ в кавычках не может встретиться внутри строкового значения: там кавычки экранированы
+    Поиск идет с конца строки: в simplified NQ нужные поля стоят после document_text
+    Возвращает сырые байты значения или None
+    """
+    i = line.rfind(key)
+    if i < 0:
+        return None
+    m = _FIELD_VALUE_RE.match(line, i + len(key))
+    return m.group(1) if m else None
+
+_COLON_RE = re.compile(rb'\s*:\s*')
+# Строка JSON или скобка: внутри строк скобки не считаются
+_CONTAINER_TOKEN_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
+def find_raw_value_span(line: bytes, key: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Ищет в сырой строке JSON границы значения поля верхнего уровня: строки, массива или объекта
+    Возвращает (начало, конец) значения вместе с кавычками или скобками, либо None
+    Значение не разбирается: его байты можно сразу вставить в выходную запись
+    """
+    i = line.rfind(key)
+    if i < 0:
+        return None
+    m = _COLON_RE.match(line, i + len(key))
+    if m is None:
+        return None
+    start = m.end()
+    opener = line[start:start + 1]
+    if opener == b'"':
+        # Конец строки - первая кавычка, перед которой четное число обратных слешей
+        end = start + 1
+        while True:
+            end = line.find(b'"', end)
+            if end < 0:
+                return None
+            slashes = 0
+            while line[end - 1 - slashes] == 0x5C:
+                slashes += 1
+            if slashes % 2 == 0:
+                return start, end + 1
+            end += 1
+    if opener in (b'[', b'{'):
+        depth = 0
+        for m in _CONTAINER_TOKEN_RE.finditer(line, start):
+            token = m.group()
+            if token in (b'[', b'{'):
+                depth += 1
+            elif token in (b']', b'}'):
+                depth -= 1
+                if depth == 0:
+                    return start, m.end()
+        return None
+    return None
+
+# Приведение ASCII букв к нижнему регистру прямо в байтах
+ASCII_LOWER_TABLE = bytes.maketrans(bytes(range(65, 91)), bytes(range(97, 123)))
+
+def ascii_question_key(raw_question: bytes) -> Optional[bytes]:
+    """
+    Нормализует сырую JSON строку вопроса (в кавычках) без ее разбора
+    Для ASCII вопроса без escape-последовательностей результат совпадает с
+    normalize_question(...) в UTF-8; для остальных возвращает None
+    """
+    if not raw_question.isascii() or b'\\' in raw_question:
+        return None
+    return raw_question[1:-1].translate(ASCII_LOWER_TABLE).strip()
+
+def parse_index_fields(line: bytes) -> Tuple[str, Any, str]:
+    """
+    Достает из строки simplified NQ (question_text, example_id, document_url)
+    Разбираются только найденные значения, а не огромные document_text и annotations;
+    если какого-то поля нет, строка разбирается целиком
+    """
+    question = find_field_value(line, b'"question_text"')
+    example_id = find_field_value(line, b'"example_id"')
+    document_url = find_field_value(line, b'"document_url"')
+    if question is None or example_id is None or document_url is None:
+        data = json_loads(line)
+        return data.get('question_text', ''), data.get('example_id', ''), data.get('document_url', '')
+    return json_loads(question), json_loads(example_id), json_loads(document_url)
+
+try:
+    import rapidgzip
+except ImportError:  # rapidgzip необязателен: без него распаковываем через isal или стандартный gzip
+    rapidgzip = None
+
+try:
+    from isal import igzip
+except ImportError:  # python-isal необязателен: без него распаковываем стандартным gzip
+    igzip = None
+
+# Размер буфера чтения распакованного потока
+GZIP_READ_BUFFER_SIZE = 128 * 1024
+
+def open_gzip(filepath: str):
+    """
+    Открывает gzip файл на чтение в бинарном режиме
+    При наличии rapidgzip распаковка идет параллельно на всех ядрах; иначе используется
+    python-isal (ISA-L inflate), если он установлен
+    """
+    if rapidgzip is not None:
+        raw = rapidgzip.open(filepath, parallelization=os.cpu_count())
+    elif igzip is not None:
+        raw = igzip.open(filepath, 'rb')
+    else:
+        raw = gzip.open(filepath, 'rb')
+    return io.BufferedReader(raw, buffer_size=GZIP_READ_BUFFER_SIZE)
+
+# Сколько фрагментов (запись и перевод строки) копится в буфере перед записью на диск
+WRITE_BATCH_SIZE = 2048
+
+def flush_lines(f, lines: List[bytes]):
+    """Записывает накопленные фрагменты одним вызовом write и очищает буфер"""
+    if lines:
+        f.write(b''.join(lines))
+        lines.clear()
+
+def unmatched_record(question: str, answer: Any) -> bytes:
+    """
+    Собирает строку unmatched по шаблону {"question": ..., "answer": ...}
+    Схема записи фиксирована, поэтому через сериализатор проходят только question и answer
+    """
+    return b'{"question":' + json_dumps(question) + b',"answer":' + json_dumps(answer) + b'}\n'
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,50 +174,125 @@ def normalize_question(text: str) -> str:
     """Нормализация текста вопроса"""
     return text.lower().strip()
 
-def create_minimal_index(filepath: str) -> dict:
+def iter_file_lines(filepath: str):
+    """
+    Построчно читает несжатый файл через mmap, отдавая строки как bytes без перевода строки
+    Файл отображается в память целиком, без буферизованного чтения через стек io
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while True:
+                end = mm.find(b'\n', start)
+                if end == -1:
+                    if start < len(mm):
+                        yield mm[start:]
+                    return
+                yield mm[start:end]
+                start = end + 1
+
+def load_needed_questions(input_files: List[str]) -> set:
     """
-    Создает минимальный индекс: вопрос -> {url, example_id, byte_offset}
-    Не хранит тексты документов и другие большие поля
+    Собирает нормализованные вопросы из файлов NQ-open
+    Файлы небольшие, так что множество занимает считанные мегабайты
+    """
+    needed = set()
+    for input_file in input_files:
+        try:
+            for line in iter_file_lines(input_file):
+                try:
+                    # Нормализация та же, что и при поиске в process_nq_open
+                    question = json_loads(line).get('question', '').strip().lower()
+                    # Пустой вопрос не ищем: он совпал бы с записями без question_text
+                    if question:
+                        needed.add(question)
+                except ValueError:
+                    continue
+        except Exception as e:
+            logging.error(f"Error reading file {input_file}: {str(e)}")
+    
+    logging.info(f"Collected {len(needed)} questions from NQ-open")
+    return needed
+
+# Большие поля simplified NQ, которые переносятся в выходную запись без разбора
+RAW_RECORD_FIELDS = (b'"document_text"', b'"annotations"', b'"long_answer_candidates"')
+
+def find_record_spans(line: bytes) -> Optional[Tuple[Tuple[int, int], ...]]:
+    """Границы полей RAW_RECORD_FIELDS в строке simplified NQ или None, если какого-то поля нет"""
+    spans = tuple(find_raw_value_span(line, key) for key in RAW_RECORD_FIELDS)
+    return None if None in spans else spans
+
+def merged_record(question: str, answer: Any, index_data: dict) -> bytes:
+    """
+    Собирает объединенную запись по шаблону из уже закодированных фрагментов
+    document_text, annotations и long_answer_candidates копируются из исходной строки как есть,
+    без разбора и повторной сериализации многомегабайтного текста
+    """
+    line = memoryview(index_data['line'])
+    (dt_start, dt_end), (ann_start, ann_end), (lac_start, lac_end) = index_data['spans']
+    return b''.join((
+        b'{"question":', json_dumps(question),
+        b',"answer":', json_dumps(answer),
+        b',"document_text":', line[dt_start:dt_end],
+        b',"document_url":', json_dumps(index_data['document_url']),
+        b',"annotations":', line[ann_start:ann_end],
+        b',"long_answer_candidates":', line[lac_start:lac_end],
+        b',"example_id":', json_dumps(index_data['example_id']),
+        b'}\n'
+    ))
+
+def create_minimal_index(filepath: str, needed: set) -> dict:
+    """
+    Создает индекс: вопрос -> {url, example_id, line}
+    Сохраняются только вопросы из needed, зато вместе с исходной строкой записи,
+    поэтому повторно распаковывать simplified NQ при записи результатов не нужно
     """
     questions_index = {}
     processed = 0
-    current_pos = 0
+    # Те же вопросы в байтах: для ASCII вопросов ненужные строки отсеиваются без декодирования
+    needed_keys = {question.encode('utf-8') for question in needed}
     
     logging.info(f"Creating index for {filepath}")
     
     try:
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
-            pbar = tqdm(desc="Indexing simplified NQ", unit=" questions")
+        with open_gzip(filepath) as f:
+            # Бар перерисовывается не чаще раза в секунду
+            pbar = tqdm(desc="Indexing simplified NQ", unit=" questions", mininterval=1.0)
             
             while True:
                 try:
-                    # Запоминаем текущую позицию
-                    pos = f.tell()
                     line = f.readline()
                     if not line:
                         break
                         
-                    data = json.loads(line.strip())
-                    question = data.get('question_text', '').strip()
-                    
-                    if question:
+                    raw_question = find_field_value(line, b'"question_text"')
+                    key = ascii_question_key(raw_question) if raw_question is not None else None
+                    if key is not None and key not in needed_keys:
+                        normalized_question = None
+                    else:
+                        question, example_id, document_url = parse_index_fields(line)
                         normalized_question = normalize_question(question)
-                        # Сохраняем только минимально необходимые данные и позицию в файле
+                    
+                    if normalized_question and normalized_question in needed:
+                        # Строка хранится как есть (байты): так она займет меньше памяти, чем разобранный dict
+                        # spans - границы больших полей в строке (см. merged_record) или None
                         questions_index[normalized_question] = {
-                            'document_url': data.get('document_url', ''),
-                            'example_id': data.get('example_id', ''),
-                            'byte_offset': pos
+                            'document_url': document_url,
+                            'example_id': example_id,
+                            'line': line,
+                            'spans': find_record_spans(line)
                         }
                     
                     processed += 1
-                    if processed % 1000 == 0:
-                        pbar.update(1000)
-                        pbar.set_postfix({'indexed': len(questions_index)})
+                    if processed % 10000 == 0:
+                        pbar.update(10000)
                 
-                except json.JSONDecodeError:
+                except ValueError:  # ошибки разбора json и orjson
                     continue
-                except Exception as e:
-                    logging.error(f"Error processing line: {str(e)}")
+                except (AttributeError, TypeError) as e:  # поле неожиданного типа
+                    logging.error("Error processing line: %s", e)
                     continue
             
             pbar.close()
@@ -75,42 +304,45 @@ def create_minimal_index(filepath: str) -> dict:
     logging.info(f"Finished indexing. Processed {processed} lines, indexed {len(questions_index)} questions")
     return questions_index
 
-def get_full_data(filepath: str, byte_offset: int) -> dict:
-    """Читает полные данные из определенной позиции в файле"""
-    try:
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
-            f.seek(byte_offset)
-            line = f.readline()
-            return json.loads(line.strip())
-    except Exception as e:
-        logging.error(f"Error reading data at offset {byte_offset}: {str(e)}")
-        return {}
-
 def process_nq_open(input_file: str, output_file: str, unmatched_file: str, 
-                   questions_index: dict, simplified_nq_path: str):
-    """Обрабатывает файл из NQ-open датасета"""
+                   questions_index: dict, position: int = 0):
+    """
+    Обрабатывает файл из NQ-open датасета
+    position - строка прогресс-бара, чтобы бары параллельных процессов не накладывались
+    """
     processed = matches = 0
+    out_lines = []
+    unmatched_lines = []
     
     try:
-        with open(input_file, 'r', encoding='utf-8') as fin, \
-             open(output_file, 'w', encoding='utf-8') as fout, \
-             open(unmatched_file, 'w', encoding='utf-8') as funmatched:
+        with open(output_file, 'wb') as fout, \
+             open(unmatched_file, 'wb') as funmatched:
             
-            pbar = tqdm(desc=f"Processing {os.path.basename(input_file)}", unit=" questions")
+            pbar = tqdm(desc=f"Processing {os.path.basename(input_file)}", unit=" questions",
+                        position=position, mininterval=1.0)
             
-            for line in fin:
+            for line in iter_file_lines(input_file):
                 try:
-                    data = json.loads(line.strip())
+                    data = json_loads(line)
                     question = data.get('question', '').strip()
                     answer = data.get('answer', [])
-                    normalized_question = normalize_question(question)
+                    # Вопрос уже без пробелов по краям, остается привести регистр
+                    normalized_question = question.lower()
                     
-                    if normalized_question in questions_index:
-                        # Получаем индексную информацию
-                        index_data = questions_index[normalized_question]
-                        
-                        # Читаем полные данные только если нашли совпадение
-                        simplified_data = get_full_data(simplified_nq_path, index_data['byte_offset'])
+                    # Получаем индексную информацию (один поиск в словаре)
+                    index_data = questions_index.get(normalized_question)
+                    if index_data is not None and index_data['spans'] is not None:
+                        out_lines.append(merged_record(question, answer, index_data))
+                        if len(out_lines) >= WRITE_BATCH_SIZE:
+                            flush_lines(fout, out_lines)
+                        matches += 1
+                    elif index_data is not None:
+                        # Границы полей не нашлись: разбираем запись целиком
+                        try:
+                            simplified_data = json_loads(index_data['line'])
+                        except ValueError as e:
+                            logging.error("Error parsing simplified NQ record: %s", e)
+                            simplified_data = {}
                         
                         if simplified_data:
                             # Создаем новую запись
@@ -124,33 +356,50 @@ def process_nq_open(input_file: str, output_file: str, unmatched_file: str,
                                 'example_id': index_data['example_id']
                             }
                             
-                            fout.write(json.dumps(merged_data, ensure_ascii=False) + '\n')
+                            out_lines.append(json_dumps(merged_data))
+                            out_lines.append(b'\n')
+                            if len(out_lines) >= WRITE_BATCH_SIZE:
+                                flush_lines(fout, out_lines)
                             matches += 1
                     else:
-                        funmatched.write(json.dumps({
-                            'question': question,
-                            'answer': answer
-                        }, ensure_ascii=False) + '\n')
+                        unmatched_lines.append(unmatched_record(question, answer))
+                        if len(unmatched_lines) >= WRITE_BATCH_SIZE:
+                            flush_lines(funmatched, unmatched_lines)
                     
                     processed += 1
-                    if processed % 100 == 0:
-                        pbar.update(100)
-                        pbar.set_postfix({
-                            'matches': f"{matches}/{processed}",
-                            'rate': f"{matches/processed*100:.1f}%"
-                        })
+                    if processed % 1000 == 0:
+                        pbar.update(1000)
                 
-                except Exception as e:
-                    logging.error(f"Error processing question: {str(e)}")
+                except (AttributeError, TypeError, ValueError) as e:  # битая строка или поле неожиданного типа
+                    logging.error("Error processing question: %s", e)
                     continue
             
+            flush_lines(fout, out_lines)
+            flush_lines(funmatched, unmatched_lines)
             pbar.close()
+            # Доля совпадений выводится один раз на файл, а не в прогресс-баре
+            if processed:
+                logging.info(f"{os.path.basename(input_file)}: matches {matches}/{processed} "
+                             f"({matches/processed*100:.1f}%)")
     
     except Exception as e:
         logging.error(f"Error processing file {input_file}: {str(e)}")
     
     return processed, matches
 
+# Индекс в процессах пула: передается один раз при запуске процесса, а не с каждой задачей
+_worker_index = None
+
+def init_worker(questions_index: dict):
+    """Инициализация процесса пула"""
+    global _worker_index
+    _worker_index = questions_index
+
+def process_nq_open_worker(job: Tuple[str, str, str, int]) -> Tuple[int, int]:
+    """process_nq_open для процесса пула: (input_file, output_file, unmatched_file, position)"""
+    input_file, output_file, unmatched_file, position = job
+    return process_nq_open(input_file, output_file, unmatched_file, _worker_index, position)
+
 def main():
     parser = argparse.ArgumentParser(description='Process NQ-open dataset')
     parser.add_argument('--dataset', choices=['train', 'dev', 'both'], default='both',
@@ -171,31 +420,48 @@ def main():
     train_unmatched = 'nq_open/unmatched_questions_train.jsonl'
     dev_unmatched = 'nq_open/unmatched_questions_dev.jsonl'
     
+    # Сначала собираем вопросы NQ-open: в индекс попадут только они
+    needed_files = []
+    if args.dataset in ['train', 'both']:
+        needed_files.append(nq_open_train)
+    if args.dataset in ['dev', 'both']:
+        needed_files.append(nq_open_dev)
+    needed = load_needed_questions(needed_files)
+    
     # Создаем индекс simplified NQ
     logging.info("Creating index for simplified NQ dataset...")
-    questions_index = create_minimal_index(simplified_nq)
+    questions_index = create_minimal_index(simplified_nq, needed)
     if not questions_index:
         logging.error("Failed to create index for simplified NQ dataset")
         return
     
     logging.info(f"Created index for {len(questions_index)} questions")
     
-    # Обрабатываем датасеты
+    # Обрабатываем датасеты: каждый в своем процессе, файлы результатов у них разные
+    jobs = []
     if args.dataset in ['train', 'both']:
-        logging.info("Processing train dataset...")
-        train_processed, train_matches = process_nq_open(
-            nq_open_train, train_output, train_unmatched, 
-            questions_index, simplified_nq
-        )
-        logging.info(f"Train dataset: processed {train_processed}, matched {train_matches}")
-    
+        jobs.append(('Train', (nq_open_train, train_output, train_unmatched, len(jobs))))
     if args.dataset in ['dev', 'both']:
-        logging.info("Processing dev dataset...")
-        dev_processed, dev_matches = process_nq_open(
-            nq_open_dev, dev_output, dev_unmatched,
-            questions_index, simplified_nq
-        )
-        logging.info(f"Dev dataset: processed {dev_processed}, matched {dev_matches}")
+        jobs.append(('Dev', (nq_open_dev, dev_output, dev_unmatched, len(jobs))))
+    
+    # Пул нужен только при fork: процессы получают индекс общими страницами памяти.
+    # При spawn/forkserver индекс в несколько ГБ копировался бы в каждый процесс через pickle
+    if len(jobs) > 1 and multiprocessing.get_start_method() == 'fork':
+        logging.info(f"Processing {len(jobs)} datasets in parallel...")
+        # Объекты индекса больше не изменятся: после fork сборщик мусора не будет трогать
+        # их страницы, и они останутся общими с родительским процессом
+        gc.freeze()
+        with multiprocessing.Pool(len(jobs), initializer=init_worker,
+                                  initargs=(questions_index,)) as pool:
+            results = pool.map(process_nq_open_worker, [job for _, job in jobs])
+    else:
+        results = []
+        for name, (input_file, output_file, unmatched_file, _) in jobs:
+            logging.info(f"Processing {name.lower()} dataset...")
+            results.append(process_nq_open(input_file, output_file, unmatched_file, questions_index))
+    
+    for (name, _), (processed, matches) in zip(jobs, results):
+        logging.info(f"{name} dataset: processed {processed}, matched {matches}")
     
     end_time = datetime.now()
     logging.info(f"Processing completed in {end_time - start_time}")
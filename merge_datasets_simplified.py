@@ -1,12 +1,61 @@
 import json
 import gzip
 import os
-from typing import Dict, List, Tuple, Set
-from collections import defaultdict
+import io
+import mmap
+from typing import Dict, List, Tuple, Set, NamedTuple, Optional
+from collections import defaultdict, Counter
 import string
-import re
+import math
+from bisect import bisect_left, bisect_right
 import logging
 from datetime import datetime
+from tqdm import tqdm
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работаем на стандартном json
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return orjson.dumps(obj)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+try:
+    import rapidgzip
+except ImportError:  # rapidgzip необязателен: без него распаковываем через isal или стандартный gzip
+    rapidgzip = None
+
+try:
+    from isal import igzip
+except ImportError:  # python-isal необязателен: без него распаковываем стандартным gzip
+    igzip = None
+
+# Размер буфера чтения распакованного потока
+GZIP_READ_BUFFER_SIZE = 128 * 1024
+
+def open_gzip(filepath: str):
+    """
+    Открывает gzip файл на последовательное чтение в бинарном режиме
+    При наличии rapidgzip распаковка идет параллельно на всех ядрах, иначе используется
+    python-isal (ISA-L inflate), если он установлен
+    """
+    if rapidgzip is not None:
+        raw = rapidgzip.open(filepath, parallelization=os.cpu_count())
+    elif igzip is not None:
+        raw = igzip.open(filepath, 'rb')
+    else:
+        raw = gzip.open(filepath, 'rb')
+    return io.BufferedReader(raw, buffer_size=GZIP_READ_BUFFER_SIZE)
 
 # Настройка логирования
 logging.basicConfig(
@@ -18,59 +67,159 @@ logging.basicConfig(
     ]
 )
 
+# Таблица замены пунктуации на пробелы для str.translate
+_PUNCT_TABLE = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
+
 def normalize_text(text: str) -> str:
     """
     Базовая нормализация текста
     """
-    text = text.lower().strip()
-    text = re.sub(f'[{string.punctuation}]', ' ', text)
-    text = ' '.join(text.split())
-    return text
+    text = text.lower().translate(_PUNCT_TABLE)
+    return ' '.join(text.split())
+
+# Стоп-слова, которые не учитываются при сравнении вопросов
+_STOP_WORDS = frozenset({'a', 'an', 'the', 'is', 'was', 'were', 'will', 'be', 'in', 'on', 'at', 'to', 'for', 'of'})
 
-def get_keywords(text: str) -> Set[str]:
+def get_normalized_keywords(normalized_text: str) -> Set[str]:
     """
-    Извлекает ключевые слова из текста
+    Извлекает ключевые слова из уже нормализованного текста (см. normalize_text)
     """
-    text = normalize_text(text)
-    stop_words = {'a', 'an', 'the', 'is', 'was', 'were', 'will', 'be', 'in', 'on', 'at', 'to', 'for', 'of'}
-    words = [w for w in text.split() if w not in stop_words]
-    return set(words)
+    return {w for w in normalized_text.split() if w not in _STOP_WORDS}
 
-def calculate_similarity(keywords1: Set[str], keywords2: Set[str]) -> float:
+class NQQuestions(NamedTuple):
     """
-    Вычисляет схожесть между двумя наборами ключевых слов
+    Вопросы simplified NQ в виде параллельных списков (qid - номер строки)
+    Вместо кортежа (URL, вопрос) на каждый вопрос хранится только номер строки в словаре
+    """
+    rows: Dict[str, int]   # нормализованный вопрос -> qid
+    urls: List[str]        # qid -> URL
+    questions: List[str]   # qid -> исходный вопрос
+
+class KeywordIndex(NamedTuple):
+    """
+    Инвертированный индекс ключевых слов вопросов NQ (qid - см. NQQuestions)
+    """
+    postings: Dict[str, List[int]]   # слово -> qid вопросов с этим словом, по возрастанию sizes
+    sizes: List[int]                  # qid -> число ключевых слов вопроса
+    keyword_sets: Dict[str, int]      # отсортированные ключевые слова через пробел -> первый qid
+
+def keyword_set_key(keywords: Set[str]) -> str:
+    """Ключ набора ключевых слов, не зависящий от их порядка"""
+    return ' '.join(sorted(keywords))
+
+def build_keyword_index(nq_questions: NQQuestions) -> KeywordIndex:
     """
-    if not keywords1 or not keywords2:
-        return 0.0
+    Строит инвертированный индекс по ключевым словам вопросов NQ
+    Ключевые слова каждого вопроса вычисляются один раз, а не при каждом поиске
+    """
+    postings = defaultdict(list)
+    sizes = []
+    keyword_sets = {}
+    
+    # Номера строк идут подряд в порядке добавления в словарь
+    for qid, nq_q in enumerate(nq_questions.rows):
+        # Ключи словаря уже нормализованы
+        keywords = get_normalized_keywords(nq_q)
+        sizes.append(len(keywords))
+        # Для совпадающих наборов запоминаем вопрос, встретившийся раньше
+        keyword_sets.setdefault(keyword_set_key(keywords), qid)
+        for keyword in keywords:
+            postings[keyword].append(qid)
     
-    intersection = len(keywords1 & keywords2)
-    union = len(keywords1 | keywords2)
+    # Сортировка по числу ключевых слов позволяет брать из списка только вопросы
+    # подходящего размера (см. find_best_match); сортировка устойчивая
+    for qids in postings.values():
+        qids.sort(key=sizes.__getitem__)
     
-    return intersection / union
+    logging.info(f"Built keyword index: {len(postings)} keywords")
+    return KeywordIndex(dict(postings), sizes, keyword_sets)
 
-def process_simplified_nq(filepath: str) -> Dict[str, Tuple[str, str]]:
+def find_best_match(
+    keywords: Set[str],
+    index: KeywordIndex,
+    similarity_threshold: float
+) -> Optional[Tuple[int, float]]:
+    """
+    Ищет вопрос NQ с наибольшей схожестью не ниже порога
+    Оцениваются только вопросы, у которых есть общие слова с keywords
+    При равной схожести побеждает вопрос, встретившийся в NQ раньше
+    Возвращает (qid, схожесть) или None
+    """
+    size = len(keywords)
+    if not size:
+        return None
+    
+    # Схожесть 1.0 - максимум, поэтому вопрос с тем же набором слов
+    # (например, отличающийся только стоп-словами) возвращается сразу
+    qid = index.keyword_sets.get(keyword_set_key(keywords))
+    if qid is not None:
+        return qid, 1.0
+    
+    # Жаккар не меньше порога только у вопросов, где число ключевых слов
+    # лежит в [threshold * K, K / threshold]; запас 1e-9 защищает от ошибок округления
+    if similarity_threshold > 0:
+        min_size = math.ceil(similarity_threshold * size - 1e-9)
+        max_size = math.floor(size / similarity_threshold + 1e-9)
+    else:
+        min_size, max_size = 0, math.inf
+    
+    # Вопрос встречается в списке каждого общего слова ровно один раз,
+    # поэтому счетчик вхождений и есть размер пересечения |A & B|
+    intersections = Counter()
+    for keyword in keywords:
+        qids = index.postings.get(keyword)
+        if qids:
+            lo = bisect_left(qids, min_size, key=index.sizes.__getitem__)
+            hi = bisect_right(qids, max_size, lo=lo, key=index.sizes.__getitem__)
+            intersections.update(qids[lo:hi])
+    
+    best_qid = -1
+    best_similarity = 0.0
+    for qid, intersection in intersections.items():
+        # Коэффициент Жаккара: |A & B| / (|A| + |B| - |A & B|)
+        similarity = intersection / (size + index.sizes[qid] - intersection)
+        if similarity >= similarity_threshold and (
+                similarity > best_similarity or (similarity == best_similarity and qid < best_qid)):
+            best_qid = qid
+            best_similarity = similarity
+    
+    if best_qid < 0:
+        return None
+    return best_qid, best_similarity
+
+def process_simplified_nq(filepath: str) -> NQQuestions:
     """
     Обрабатывает упрощенную версию NQ датасета
-    Возвращает словарь: вопрос -> (URL, исходный вопрос)
+    Возвращает вопросы: нормализованный вопрос -> qid, по qid - URL и исходный вопрос
     """
-    questions_dict = {}
+    nq_questions = NQQuestions({}, [], [])
     total_processed = 0
     
     try:
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
+        with open_gzip(filepath) as f:
+            # Бар обновляется раз в 1000 строк и перерисовывается не чаще раза в секунду
+            pbar = tqdm(desc="Loading simplified NQ", unit=" lines", mininterval=1.0)
+            
             for line_num, line in enumerate(f, 1):
+                if line_num % 1000 == 0:
+                    pbar.update(1000)
                 try:
-                    data = json.loads(line.strip())
+                    data = json_loads(line)
                     question = data.get('question_text', '').strip()
                     url = data.get('document_url', '')
                     
                     if question and url:
                         normalized_question = normalize_text(question)
-                        questions_dict[normalized_question] = (url, question)
+                        # Повторный вопрос перезаписывает свою строку
+                        qid = nq_questions.rows.get(normalized_question)
+                        if qid is None:
+                            nq_questions.rows[normalized_question] = len(nq_questions.urls)
+                            nq_questions.urls.append(url)
+                            nq_questions.questions.append(question)
+                        else:
+                            nq_questions.urls[qid] = url
+                            nq_questions.questions[qid] = question
                         total_processed += 1
-                        
-                        if line_num % 10000 == 0:
-                            logging.info(f"Processed {line_num} lines from simplified NQ dataset")
                 
                 except json.JSONDecodeError:
                     logging.error(f"Error parsing JSON at line {line_num}")
@@ -78,18 +227,49 @@ def process_simplified_nq(filepath: str) -> Dict[str, Tuple[str, str]]:
                 except Exception as e:
                     logging.error(f"Error processing line {line_num}: {str(e)}")
                     continue
+            
+            pbar.close()
     
     except Exception as e:
         logging.error(f"Error reading file {filepath}: {str(e)}")
     
     logging.info(f"Finished processing simplified NQ dataset. Total questions: {total_processed}")
-    return questions_dict
+    return nq_questions
+
+# Сколько фрагментов (запись и перевод строки) копится в буфере перед записью на диск
+WRITE_BATCH_SIZE = 2048
+
+def flush_lines(f, lines: List[bytes]):
+    """Записывает накопленные фрагменты одним вызовом write и очищает буфер"""
+    if lines:
+        f.write(b''.join(lines))
+        lines.clear()
+
+def iter_file_lines(filepath: str):
+    """
+    Построчно читает несжатый файл через mmap, отдавая строки как bytes без перевода строки
+    Файл отображается в память целиком, без буферизованного чтения через стек io
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while True:
+                end = mm.find(b'\n', start)
+                if end == -1:
+                    if start < len(mm):
+                        yield mm[start:]
+                    return
+                yield mm[start:end]
+                start = end + 1
 
 def process_efficient_qa(
     input_file: str,
     output_file: str,
     unmatched_file: str,
-    nq_questions: Dict[str, Tuple[str, str]],
+    nq_questions: NQQuestions,
+    keyword_index: KeywordIndex,
     similarity_threshold: float = 0.9
 ) -> Tuple[int, int, List[Tuple[str, str, str, str, float]]]:
     """
@@ -99,14 +279,16 @@ def process_efficient_qa(
     processed = 0
     matches_found = 0
     match_examples = []  # [(eq_question, eq_answer, nq_question, url, similarity)]
+    out_lines = []
+    unmatched_lines = []
     
-    with open(input_file, 'r', encoding='utf-8') as fin, \
-         open(output_file, 'w', encoding='utf-8') as fout, \
-         open(unmatched_file, 'w', encoding='utf-8') as funmatched:
+    with open(output_file, 'wb') as fout, \
+         open(unmatched_file, 'wb') as funmatched:
         
-        for line in fin:
+        for line in tqdm(iter_file_lines(input_file), desc=f"Processing {os.path.basename(input_file)}",
+                         unit=" questions", mininterval=1.0):
             try:
-                data = json.loads(line.strip())
+                data = json_loads(line)
                 question = data.get('question', '').strip()
                 answer = data.get('answer', [''])[0]
                 
@@ -120,18 +302,19 @@ def process_efficient_qa(
                 best_nq_question = ''
                 
                 # Сначала проверяем точное совпадение
-                if normalized_question in nq_questions:
-                    best_url, best_nq_question = nq_questions[normalized_question]
+                qid = nq_questions.rows.get(normalized_question)
+                if qid is not None:
+                    best_url = nq_questions.urls[qid]
+                    best_nq_question = nq_questions.questions[qid]
                     best_similarity = 1.0
                 else:
                     # Если точного совпадения нет, ищем похожие
-                    q1_keywords = get_keywords(normalized_question)
-                    for nq_q, (url, orig_q) in nq_questions.items():
-                        similarity = calculate_similarity(q1_keywords, get_keywords(nq_q))
-                        if similarity >= similarity_threshold and similarity > best_similarity:
-                            best_similarity = similarity
-                            best_url = url
-                            best_nq_question = orig_q
+                    q1_keywords = get_normalized_keywords(normalized_question)
+                    match = find_best_match(q1_keywords, keyword_index, similarity_threshold)
+                    if match is not None:
+                        qid, best_similarity = match
+                        best_url = nq_questions.urls[qid]
+                        best_nq_question = nq_questions.questions[qid]
                 
                 if best_similarity >= similarity_threshold:
                     # Добавляем информацию из NQ
@@ -147,25 +330,33 @@ def process_efficient_qa(
                         ))
                 else:
                     # Сохраняем ненайденный вопрос
-                    funmatched.write(json.dumps({
+                    unmatched_lines.append(json_dumps({
                         'question': question,
                         'answer': answer
-                    }, ensure_ascii=False) + '\n')
+                    }))
+                    unmatched_lines.append(b'\n')
+                    if len(unmatched_lines) >= WRITE_BATCH_SIZE:
+                        flush_lines(funmatched, unmatched_lines)
                 
                 # Записываем обновленные данные
-                fout.write(json.dumps(data, ensure_ascii=False) + '\n')
+                out_lines.append(json_dumps(data))
+                out_lines.append(b'\n')
+                if len(out_lines) >= WRITE_BATCH_SIZE:
+                    flush_lines(fout, out_lines)
                 processed += 1
                 
-                if processed % 100 == 0:
-                    logging.info(f"Processed {processed} questions, found matches for {matches_found}")
-                
             except json.JSONDecodeError:
                 logging.error(f"Error parsing JSON in efficient_qa dataset")
                 continue
             except Exception as e:
                 logging.error(f"Error processing question: {str(e)}")
                 continue
+        
+        flush_lines(fout, out_lines)
+        flush_lines(funmatched, unmatched_lines)
     
+    # Число совпадений выводится один раз на файл
+    logging.info(f"Processed {processed} questions, found matches for {matches_found}")
     return processed, matches_found, match_examples
 
 def main():
@@ -186,18 +377,19 @@ def main():
     # Читаем упрощенный NQ датасет
     logging.info(f"Processing simplified NQ dataset: {simplified_nq}")
     nq_questions = process_simplified_nq(simplified_nq)
-    logging.info(f"Loaded {len(nq_questions)} questions from simplified NQ dataset")
+    logging.info(f"Loaded {len(nq_questions.rows)} questions from simplified NQ dataset")
+    keyword_index = build_keyword_index(nq_questions)
     
     # Обрабатываем efficient_qa dev датасет
     logging.info("Processing efficient_qa dev dataset...")
     dev_processed, dev_matches, dev_examples = process_efficient_qa(
-        efficient_qa_dev, dev_output, dev_unmatched, nq_questions
+        efficient_qa_dev, dev_output, dev_unmatched, nq_questions, keyword_index
     )
     
     # Обрабатываем efficient_qa test датасет
     logging.info("Processing efficient_qa test dataset...")
     test_processed, test_matches, test_examples = process_efficient_qa(
-        efficient_qa_test, test_output, test_unmatched, nq_questions
+        efficient_qa_test, test_output, test_unmatched, nq_questions, keyword_index
     )
     
     # Записываем подробный отчет
@@ -216,7 +408,7 @@ def main():
         
         f.write("Simplified NQ Dataset Statistics\n")
         f.write("-" * 80 + "\n")
-        f.write(f"Total questions loaded: {len(nq_questions)}\n\n")
+        f.write(f"Total questions loaded: {len(nq_questions.rows)}\n\n")
         
         f.write("Efficient QA Dev Dataset\n")
         f.write("-" * 80 + "\n")
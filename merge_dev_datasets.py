@@ -2,8 +2,28 @@ import json
 import logging
 from datetime import datetime
 import os
+import mmap
+from typing import Dict, List
 from tqdm import tqdm
 
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работаем на стандартном json
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return orjson.dumps(obj)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -18,31 +38,38 @@ def normalize_question(text: str) -> str:
     """Нормализация текста вопроса"""
     return text.lower().strip()
 
-def load_simplified_nq(filepath: str) -> dict:
-    """Загружает данные из упрощенного NQ dev датасета"""
+def load_simplified_nq(filepath: str) -> Dict[str, int]:
+    """
+    Индексирует упрощенный NQ dev датасет
+    Возвращает словарь: нормализованный вопрос -> смещение строки в файле
+    Сами записи (с document_text) в памяти не держатся и читаются при совпадении
+    """
     questions_dict = {}
     processed = 0
     
     logging.info(f"Starting to read {filepath}")
     
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            # Создаем progress bar без предварительного подсчета строк
-            pbar = tqdm(desc="Loading simplified NQ dev", unit=" questions")
+        with open(filepath, 'rb') as f:
+            # Создаем progress bar без предварительного подсчета строк,
+            # перерисовывается не чаще раза в секунду
+            pbar = tqdm(desc="Loading simplified NQ dev", unit=" questions", mininterval=1.0)
             
+            offset = 0
             for line in f:
+                line_offset = offset
+                offset += len(line)
                 try:
-                    data = json.loads(line.strip())
+                    data = json_loads(line)
                     question = data.get('question', '').strip()
                     
                     if question:
                         normalized_question = normalize_question(question)
-                        questions_dict[normalized_question] = data
+                        questions_dict[normalized_question] = line_offset
                     
                     processed += 1
                     if processed % 1000 == 0:
                         pbar.update(1000)
-                        pbar.set_postfix({'loaded': len(questions_dict)})
                 
                 except json.JSONDecodeError:
                     continue
@@ -59,28 +86,66 @@ def load_simplified_nq(filepath: str) -> dict:
     logging.info(f"Finished loading. Processed {processed} lines, loaded {len(questions_dict)} questions")
     return questions_dict
 
-def process_nq_open(input_file: str, output_file: str, unmatched_file: str, simplified_nq_data: dict):
+def iter_file_lines(filepath: str):
+    """
+    Построчно читает несжатый файл через mmap, отдавая строки как bytes без перевода строки
+    Файл отображается в память целиком, без буферизованного чтения через стек io
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while True:
+                end = mm.find(b'\n', start)
+                if end == -1:
+                    if start < len(mm):
+                        yield mm[start:]
+                    return
+                yield mm[start:end]
+                start = end + 1
+
+# Сколько фрагментов (запись и перевод строки) копится в буфере перед записью на диск
+WRITE_BATCH_SIZE = 2048
+
+def flush_lines(f, lines: List[bytes]):
+    """Записывает накопленные фрагменты одним вызовом write и очищает буфер"""
+    if lines:
+        f.write(b''.join(lines))
+        lines.clear()
+
+def read_record(f, offset: int) -> dict:
+    """Читает и разбирает запись, начинающуюся со смещения offset"""
+    f.seek(offset)
+    return json_loads(f.readline())
+
+def process_nq_open(input_file: str, output_file: str, unmatched_file: str,
+                    simplified_nq_file: str, simplified_nq_data: Dict[str, int]):
     """Обрабатывает файл из NQ-open датасета"""
     processed = matches = 0
+    out_lines = []
+    unmatched_lines = []
     
     try:
-        with open(input_file, 'r', encoding='utf-8') as fin, \
-             open(output_file, 'w', encoding='utf-8') as fout, \
-             open(unmatched_file, 'w', encoding='utf-8') as funmatched:
+        with open(simplified_nq_file, 'rb') as fnq, \
+             open(output_file, 'wb') as fout, \
+             open(unmatched_file, 'wb') as funmatched:
             
             # Создаем progress bar
-            pbar = tqdm(desc=f"Processing {os.path.basename(input_file)}", unit=" questions")
+            pbar = tqdm(desc=f"Processing {os.path.basename(input_file)}", unit=" questions",
+                        mininterval=1.0)
             
-            for line in fin:
+            for line in iter_file_lines(input_file):
                 try:
-                    data = json.loads(line.strip())
+                    data = json_loads(line)
                     question = data.get('question', '').strip()
                     answer = data.get('answer', [])
                     normalized_question = normalize_question(question)
                     
-                    if normalized_question in simplified_nq_data:
+                    offset = simplified_nq_data.get(normalized_question)
+                    if offset is not None:
                         # Получаем данные из simplified NQ
-                        simplified_data = simplified_nq_data[normalized_question]
+                        simplified_data = read_record(fnq, offset)
                         
                         # Создаем новую запись
                         merged_data = {
@@ -93,27 +158,35 @@ def process_nq_open(input_file: str, output_file: str, unmatched_file: str, simp
                             'example_id': simplified_data.get('example_id', '')
                         }
                         
-                        fout.write(json.dumps(merged_data, ensure_ascii=False) + '\n')
+                        out_lines.append(json_dumps(merged_data))
+                        out_lines.append(b'\n')
+                        if len(out_lines) >= WRITE_BATCH_SIZE:
+                            flush_lines(fout, out_lines)
                         matches += 1
                     else:
-                        funmatched.write(json.dumps({
+                        unmatched_lines.append(json_dumps({
                             'question': question,
                             'answer': answer
-                        }, ensure_ascii=False) + '\n')
+                        }))
+                        unmatched_lines.append(b'\n')
+                        if len(unmatched_lines) >= WRITE_BATCH_SIZE:
+                            flush_lines(funmatched, unmatched_lines)
                     
                     processed += 1
-                    if processed % 100 == 0:
-                        pbar.update(100)
-                        pbar.set_postfix({
-                            'matches': f"{matches}/{processed}",
-                            'rate': f"{matches/processed*100:.1f}%"
-                        })
+                    if processed % 1000 == 0:
+                        pbar.update(1000)
                 
                 except Exception as e:
                     logging.error(f"Error processing question: {str(e)}")
                     continue
             
+            flush_lines(fout, out_lines)
+            flush_lines(funmatched, unmatched_lines)
             pbar.close()
+            # Доля совпадений выводится один раз на файл, а не в прогресс-баре
+            if processed:
+                logging.info(f"{os.path.basename(input_file)}: matches {matches}/{processed} "
+                             f"({matches/processed*100:.1f}%)")
     
     except Exception as e:
         logging.error(f"Error processing file {input_file}: {str(e)}")
@@ -144,7 +217,7 @@ def main():
     # Обрабатываем dev датасет
     logging.info("Processing dev dataset...")
     dev_processed, dev_matches = process_nq_open(
-        nq_open_dev, dev_output, dev_unmatched, simplified_nq_data
+        nq_open_dev, dev_output, dev_unmatched, simplified_nq_dev, simplified_nq_data
     )
     logging.info(f"Dev dataset: processed {dev_processed}, matched {dev_matches}")
     
@@ -0,0 +1,43 @@
+"""
+Общие функции обработки текста вопросов для test_matching.py и test_similarity.py
+"""
+import functools
+import string
+from typing import FrozenSet, List, Set
+
+# Таблица замены пунктуации на пробелы для str.translate
+_PUNCT_TABLE = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
+
+def tokenize(text: str) -> List[str]:
+    """
+    Слова нормализованного текста, без промежуточной строки normalize_text
+    """
+    # Приводим к нижнему регистру и заменяем пунктуацию на пробелы
+    return text.lower().translate(_PUNCT_TABLE).split()
+
+def normalize_text(text: str) -> str:
+    """
+    Базовая нормализация текста
+    """
+    # Убираем множественные пробелы
+    return ' '.join(tokenize(text))
+
+@functools.lru_cache(maxsize=200_000)
+def get_keywords(text: str, stop_words: FrozenSet[str] = frozenset()) -> FrozenSet[str]:
+    """
+    Извлекает ключевые слова из текста, исключая stop_words
+    Результат кэшируется: повторы вопросов в NQ и запросы разбираются один раз,
+    поэтому возвращается неизменяемый frozenset
+    """
+    return frozenset(w for w in tokenize(text) if w not in stop_words)
+
+def calculate_similarity(keywords1: Set[str], keywords2: Set[str]) -> float:
+    """
+    Вычисляет схожесть между двумя наборами ключевых слов
+    """
+    if not keywords1 or not keywords2:
+        return 0.0
+
+    # |A | B| = |A| + |B| - |A & B|, объединение не строится
+    intersection = len(keywords1 & keywords2)
+    return intersection / (len(keywords1) + len(keywords2) - intersection)
@@ -1,11 +1,46 @@
 import json
 import gzip
 import os
+import mmap
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from typing import Set, Tuple, Dict, Any
+from typing import Set, Tuple, Dict, Any, List
 import logging
-import re
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работаем на стандартном json
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return orjson.dumps(obj)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Сериализует запись в JSON (UTF-8 байты)"""
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+try:
+    from isal import igzip
+except ImportError:  # python-isal необязателен: без него распаковываем стандартным gzip
+    igzip = None
+
+def open_gzip(filepath: str):
+    """
+    Открывает gzip файл на чтение в бинарном режиме, через python-isal (ISA-L inflate),
+    если он установлен
+    Файлы и так распаковываются параллельно в разных процессах (см. read_nq_dataset),
+    поэтому многопоточная распаковка внутри файла не нужна
+    """
+    if igzip is not None:
+        return igzip.open(filepath, 'rb')
+    return gzip.open(filepath, 'rb')
 
 # Настройка логирования
 logging.basicConfig(
@@ -17,29 +52,28 @@ logging.basicConfig(
     ]
 )
 
+# Таблица удаления знаков препинания для str.translate
+_PUNCT_DELETE_TABLE = str.maketrans('', '', '.,?!')
+_QUESTION_WORDS = frozenset(['what', 'when', 'where', 'who', 'why', 'how', 'which', 'whose', 'whom'])
+_COPULA_WORDS = frozenset(['is', 'was', 'were'])
+
 def normalize_question(question: str) -> str:
     """
     Нормализация вопроса для лучшего сопоставления
     """
-    # Приводим к нижнему регистру
-    question = question.lower().strip()
-    
-    # Удаляем знаки препинания
-    question = re.sub(r'[.,?!]', '', question)
-    
-    # Удаляем множественные пробелы
-    question = ' '.join(question.split())
+    # Приводим к нижнему регистру и удаляем знаки препинания
+    words = question.lower().translate(_PUNCT_DELETE_TABLE).split()
     
     # Удаляем вопросительные слова в начале
-    question_words = ['what', 'when', 'where', 'who', 'why', 'how', 'which', 'whose', 'whom']
-    words = question.split()
-    if words and words[0] in question_words:
-        question = ' '.join(words[1:])
+    if words and words[0] in _QUESTION_WORDS:
+        words = words[1:]
         
-    # Если после what is/was/were, убираем и это
-    question = re.sub(r'^(is|was|were)\s+', '', question)
+    # Если после what is/was/were, убираем и это (только если за ним есть слово)
+    if len(words) > 1 and words[0] in _COPULA_WORDS:
+        words = words[1:]
     
-    return question
+    # Слова соединяются одним пробелом, что заодно убирает множественные пробелы
+    return ' '.join(words)
 
 def init_database(db_path: str):
     """
@@ -48,26 +82,38 @@ def init_database(db_path: str):
     conn = sqlite3.connect(db_path)
     c = conn.cursor()
     
-    # Создаем таблицу для хранения всех данных в формате JSON
+    # База каждый раз строится заново (см. main), поэтому надежность записи
+    # при сбое не нужна: WAL без fsync, большой кэш страниц, временные данные в памяти
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=OFF')
+    c.execute('PRAGMA cache_size=-262144')  # 256 МБ
+    c.execute('PRAGMA temp_store=MEMORY')
+    
+    # Поля NQ хранятся отдельными колонками; annotations и long_answer_candidates -
+    # готовым JSON в BLOB, чтобы при поиске их не нужно было разбирать
+    # PRIMARY KEY уже создает индекс по question, отдельный индекс не нужен
     c.execute('''CREATE TABLE IF NOT EXISTS question_data
-                 (question TEXT PRIMARY KEY, original_question TEXT, data_json TEXT)''')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_question ON question_data(question)')
+                 (question TEXT PRIMARY KEY, original_question TEXT, document_url TEXT,
+                  document_title TEXT, annotations BLOB, long_answer_candidates BLOB)''')
     conn.commit()
     return conn
 
-def process_nq_file(filepath: str, conn: sqlite3.Connection, batch_size: int = 1000):
+# Строка таблицы question_data: (нормализованный вопрос, оригинальный вопрос,
+# document_url, document_title, JSON annotations, JSON long_answer_candidates)
+QuestionRow = Tuple[str, str, str, str, bytes, bytes]
+
+def read_nq_rows(filepath: str) -> List[QuestionRow]:
     """
-    Обработка одного NQ файла и сохранение всех данных в SQLite
+    Читает один NQ файл и готовит строки для таблицы question_data
+    Вызывается в отдельных процессах, поэтому не трогает базу
     """
-    batch = []
-    cursor = conn.cursor()
-    processed = 0
+    rows = []
     
     try:
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
+        with open_gzip(filepath) as f:
             for line in f:
                 try:
-                    data = json.loads(line.strip())
+                    data = json_loads(line)
                     
                     # В NQ датасете вопрос находится в поле question_text
                     question = data.get('question_text', '').strip()
@@ -77,46 +123,42 @@ def process_nq_file(filepath: str, conn: sqlite3.Connection, batch_size: int = 1
                         normalized_question = normalize_question(question)
                         
                         # Сохраняем все поля кроме тех, что есть в efficient_qa
-                        stored_data = {
-                            'document_url': data.get('document_url', ''),
-                            'document_title': data.get('document_title', ''),
-                            'annotations': data.get('annotations', []),
-                            'long_answer_candidates': data.get('long_answer_candidates', [])
-                        }
-                        
-                        batch.append((
+                        rows.append((
                             normalized_question,
                             question,  # оригинальный вопрос
-                            json.dumps(stored_data, ensure_ascii=False)
+                            data.get('document_url', ''),
+                            data.get('document_title', ''),
+                            json_dumps(data.get('annotations', [])),
+                            json_dumps(data.get('long_answer_candidates', []))
                         ))
-                        processed += 1
-                        
-                        if len(batch) >= batch_size:
-                            cursor.executemany(
-                                'INSERT OR REPLACE INTO question_data (question, original_question, data_json) VALUES (?, ?, ?)',
-                                batch
-                            )
-                            conn.commit()
-                            batch = []
                             
                 except json.JSONDecodeError:
                     continue
                 except Exception as e:
                     logging.error(f"Error processing line in {filepath}: {str(e)}")
                     continue
-            
-            # Сохраняем оставшиеся записи
-            if batch:
-                cursor.executemany(
-                    'INSERT OR REPLACE INTO question_data (question, original_question, data_json) VALUES (?, ?, ?)',
-                    batch
-                )
-                conn.commit()
                 
     except Exception as e:
         logging.error(f"Error processing file {filepath}: {str(e)}")
     
-    return processed
+    return rows
+
+def process_nq_file(rows: List[QuestionRow], conn: sqlite3.Connection, batch_size: int = 1000):
+    """
+    Сохранение строк одного NQ файла (см. read_nq_rows) в SQLite
+    """
+    cursor = conn.cursor()
+    
+    for i in range(0, len(rows), batch_size):
+        cursor.executemany(
+            'INSERT OR REPLACE INTO question_data (question, original_question, document_url, '
+            'document_title, annotations, long_answer_candidates) VALUES (?, ?, ?, ?, ?, ?)',
+            rows[i:i + batch_size]
+        )
+    
+    # Одна транзакция на файл
+    conn.commit()
+    return len(rows)
 
 def read_nq_dataset(nq_dir: str, db_path: str):
     """
@@ -131,12 +173,18 @@ def read_nq_dataset(nq_dir: str, db_path: str):
     for dir_name in directories:
         dir_path = os.path.join(nq_dir, dir_name)
         files = [f for f in os.listdir(dir_path) if f.endswith('.jsonl.gz')]
+        filepaths = [os.path.join(dir_path, filename) for filename in files]
         
-        for filename in tqdm(files, desc=f"Processing {dir_name} files"):
-            filepath = os.path.join(dir_path, filename)
-            processed = process_nq_file(filepath, conn)
-            total_processed += processed
-            logging.info(f"Processed file: {filename} (found {processed} questions)")
+        # Файлы распаковываются и разбираются параллельно, в базу строки пишутся
+        # в порядке файлов, чтобы при повторах вопросов побеждала та же запись
+        max_workers = max(1, min(len(filepaths), os.cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(read_nq_rows, filepaths)
+            for filename, rows in tqdm(zip(files, results), total=len(files),
+                                       desc=f"Processing {dir_name} files"):
+                processed = process_nq_file(rows, conn)
+                total_processed += processed
+                logging.info(f"Processed file: {filename} (found {processed} questions)")
     
     logging.info(f"Total questions processed: {total_processed}")
     
@@ -152,6 +200,105 @@ def read_nq_dataset(nq_dir: str, db_path: str):
     
     return conn
 
+# Сколько вопросов передается в одном запросе IN (...): с запасом ниже
+# лимита SQLite на число параметров (999 в старых версиях)
+SQLITE_IN_CHUNK_SIZE = 500
+
+def fetch_question_data(cursor: sqlite3.Cursor, normalized_questions: Set[str]) -> Dict[str, QuestionRow]:
+    """
+    Достает данные для набора нормализованных вопросов запросами WHERE question IN (...)
+    Возвращает словарь: нормализованный вопрос -> строка таблицы question_data
+    """
+    found = {}
+    questions = list(normalized_questions)
+    for i in range(0, len(questions), SQLITE_IN_CHUNK_SIZE):
+        chunk = questions[i:i + SQLITE_IN_CHUNK_SIZE]
+        cursor.execute(
+            f"SELECT question, original_question, document_url, document_title, "
+            f"annotations, long_answer_candidates FROM question_data "
+            f"WHERE question IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+        for row in cursor.fetchall():
+            found[row[0]] = row
+    return found
+
+# Поля, которые merged_record дописывает в конец записи готовым JSON
+RAW_NQ_FIELDS = ('annotations', 'long_answer_candidates', 'nq_original_question')
+
+def merged_record(data: Dict[str, Any], row: QuestionRow) -> bytes:
+    """
+    Сериализует запись efficient_qa, дополненную полями NQ из строки базы
+    JSON annotations и long_answer_candidates вставляется как есть, без разбора
+    """
+    _, original_question, document_url, document_title, annotations, long_answer_candidates = row
+    fields = {key: value for key, value in data.items() if key not in RAW_NQ_FIELDS}
+    fields['document_url'] = document_url
+    fields['document_title'] = document_title
+    # fields не пуст, поэтому сериализация заканчивается на '}' после последнего поля
+    return b''.join((
+        json_dumps(fields)[:-1],
+        b',"annotations":', annotations,
+        b',"long_answer_candidates":', long_answer_candidates,
+        # сохраняем оригинальный вопрос для анализа
+        b',"nq_original_question":', json_dumps(original_question),
+        b'}'
+    ))
+
+def write_efficient_qa_batch(
+    batch: List[Tuple[Dict[str, Any], str, str]],
+    cursor: sqlite3.Cursor,
+    fout,
+    questions_with_refs: Set[str],
+    questions_without_refs: Set[str],
+    input_file: str
+):
+    """
+    Дополняет батч (данные, вопрос, нормализованный вопрос) данными из базы и записывает его
+    Все вопросы батча ищутся в базе разом
+    """
+    found = fetch_question_data(cursor, {normalized_question for _, _, normalized_question in batch})
+    out_lines = []
+    
+    for data, question, normalized_question in batch:
+        try:
+            row = found.get(normalized_question)
+            
+            if row is not None:
+                # Добавляем все дополнительные поля из NQ датасета
+                out_lines.append(merged_record(data, row))
+                questions_with_refs.add(question)
+            else:
+                out_lines.append(json_dumps(data))
+                questions_without_refs.add(question)
+            out_lines.append(b'\n')
+        
+        except Exception as e:
+            logging.error(f"Error processing line in {input_file}: {str(e)}")
+            continue
+    
+    # Весь батч записывается одним вызовом write
+    fout.write(b''.join(out_lines))
+
+def iter_file_lines(filepath: str):
+    """
+    Построчно читает несжатый файл через mmap, отдавая строки как bytes без перевода строки
+    Файл отображается в память целиком, без буферизованного чтения через стек io
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while True:
+                end = mm.find(b'\n', start)
+                if end == -1:
+                    if start < len(mm):
+                        yield mm[start:]
+                    return
+                yield mm[start:end]
+                start = end + 1
+
 def process_efficient_qa_batch(
     input_file: str,
     output_file: str,
@@ -166,37 +313,20 @@ def process_efficient_qa_batch(
     questions_without_refs = set()
     questions_with_refs = set()
     
-    with open(input_file, 'r', encoding='utf-8') as fin, \
-         open(output_file, 'w', encoding='utf-8') as fout:
+    with open(output_file, 'wb') as fout:
         
         batch = []
-        for line in tqdm(fin, desc=f"Processing {os.path.basename(input_file)}"):
+        for line in tqdm(iter_file_lines(input_file), desc=f"Processing {os.path.basename(input_file)}"):
             try:
-                data = json.loads(line.strip())
+                data = json_loads(line)
                 question = data.get('question', '').strip()
                 normalized_question = normalize_question(question)
-                
-                # Проверяем наличие данных в базе
-                cursor.execute('SELECT original_question, data_json FROM question_data WHERE question = ?', 
-                             (normalized_question,))
-                result = cursor.fetchone()
-                
-                if result:
-                    # Добавляем все дополнительные поля из NQ датасета
-                    original_question, additional_data_json = result
-                    additional_data = json.loads(additional_data_json)
-                    data.update(additional_data)
-                    data['nq_original_question'] = original_question  # сохраняем оригинальный вопрос для анализа
-                    questions_with_refs.add(question)
-                else:
-                    questions_without_refs.add(question)
-                
-                batch.append(data)
+                batch.append((data, question, normalized_question))
                 
                 if len(batch) >= batch_size:
-                    # Записываем батч
-                    for item in batch:
-                        fout.write(json.dumps(item, ensure_ascii=False) + '\n')
+                    # Ищем и записываем батч
+                    write_efficient_qa_batch(batch, cursor, fout, questions_with_refs,
+                                             questions_without_refs, input_file)
                     batch = []
                     
             except json.JSONDecodeError:
@@ -208,8 +338,8 @@ def process_efficient_qa_batch(
         
         # Записываем оставшийся батч
         if batch:
-            for item in batch:
-                fout.write(json.dumps(item, ensure_ascii=False) + '\n')
+            write_efficient_qa_batch(batch, cursor, fout, questions_with_refs,
+                                     questions_without_refs, input_file)
     
     # Сохраняем список вопросов без совпадений
     with open(unmatched_file, 'w', encoding='utf-8') as f:
@@ -222,18 +352,13 @@ def process_efficient_qa_batch(
     # Выводим примеры успешных совпадений
     if questions_with_refs:
         logging.info("Examples of successful matches:")
-        cursor.execute('''
-            SELECT q.question, q.original_question 
-            FROM question_data q 
-            WHERE q.question IN (
-                SELECT normalize_question(?) 
-                FROM (SELECT ? AS q UNION ALL SELECT ? UNION ALL SELECT ? UNION ALL SELECT ? UNION ALL SELECT ?) t
-            )
-        ''', list(questions_with_refs)[:5] * 6)
-        matches = cursor.fetchall()
-        for norm, orig in matches:
+        # Вопросы нормализуются в Python: в SQLite нет функции normalize_question
+        examples = fetch_question_data(
+            cursor, {normalize_question(q) for q in list(questions_with_refs)[:5]}
+        )
+        for norm, row in examples.items():
             logging.info(f"Efficient QA: {norm}")
-            logging.info(f"NQ Original: {orig}")
+            logging.info(f"NQ Original: {row[1]}")
             logging.info("---")
     
     # Выводим примеры вопросов без совпадений
@@ -262,10 +387,13 @@ def main():
     db_path = 'question_refs.db'
     
     try:
-        # Удаляем старую базу данных, если она существует
+        # Удаляем старую базу данных, если она существует, вместе с файлами WAL
         if os.path.exists(db_path):
             os.remove(db_path)
             logging.info("Removed old database")
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
         
         logging.info("Creating new database and processing NQ dataset...")
         db_conn = read_nq_dataset(nq_dir, db_path)
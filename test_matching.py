@@ -1,126 +1,332 @@
 import json
 import gzip
 import os
+import io
+import sys
+import mmap
+import math
 import re
-from typing import Dict, List, Tuple, Set
-from collections import defaultdict
-import string
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Tuple, Set, FrozenSet, NamedTuple, Optional, Sequence
+from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
+import nq_text
 
-def get_stop_words() -> Set[str]:
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работаем на стандартном json
+    orjson = None
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+try:
+    import simdjson
+except ImportError:  # simdjson необязателен: без него строка разбирается целиком
+    simdjson = None
+
+if simdjson is not None:
+    # Один парсер на процесс: simdjson переиспользует его буферы между строками
+    _FIELDS_PARSER = simdjson.Parser()
+
+    def parse_line_fields(line: bytes) -> Tuple[str, str]:
+        """
+        Разбирает строку NQ и достает (question_text, document_url)
+        Документ (document_html, document_tokens, ...) в dict не собирается
+        """
+        doc = _FIELDS_PARSER.parse(line)
+        return doc.get('question_text', ''), doc.get('document_url', '')
+else:
+    def parse_line_fields(line: bytes) -> Tuple[str, str]:
+        """Разбирает строку NQ и достает (question_text, document_url)"""
+        data = json_loads(line)
+        return data.get('question_text', ''), data.get('document_url', '')
+
+# Строковое значение поля сразу после ключа
+_STRING_VALUE_RE = re.compile(rb'\s*:\s*("(?:[^"\\]|\\.)*")')
+
+def find_string_value(line: bytes, key: bytes) -> Optional[bytes]:
     """
-    Возвращает список стоп-слов
+    Ищет в сырой строке JSON строковое значение поля верхнего уровня, не разбирая остальную запись
+    Ключ в кавычках не может встретиться внутри строкового значения: там кавычки экранированы
+    Поиск идет с конца строки: в NQ нужные поля стоят после document_html и document_tokens
+    Возвращает сырые байты значения (в кавычках) или None
     """
-    return {
-        'a', 'an', 'the', 'is', 'was', 'were', 'will', 'be', 'to', 'of', 'and',
-        'in', 'on', 'at', 'by', 'for', 'with', 'about', 'from', 'did', 'does',
-        'do', 'has', 'have', 'had', 'what', 'when', 'where', 'who', 'why', 'how',
-        'which', 'whose', 'whom', 'that'
-    }
+    i = line.rfind(key)
+    if i < 0:
+        return None
+    m = _STRING_VALUE_RE.match(line, i + len(key))
+    return m.group(1) if m else None
 
-def normalize_text(text: str) -> str:
+def parse_question_fields(line: bytes) -> Tuple[str, str]:
     """
-    Базовая нормализация текста
+    Достает из строки NQ только (question_text, document_url)
+    Разбираются только найденные значения; если поле не нашлось, строка разбирается целиком
     """
-    # Приводим к нижнему регистру
-    text = text.lower().strip()
-    # Заменяем пунктуацию на пробелы
-    text = re.sub(f'[{string.punctuation}]', ' ', text)
-    # Убираем множественные пробелы
-    text = ' '.join(text.split())
-    return text
+    question = find_string_value(line, b'"question_text"')
+    url = find_string_value(line, b'"document_url"')
+    if question is None or url is None:
+        return parse_line_fields(line)
+    return json_loads(question), json_loads(url)
+
+# Стоп-слова, строятся один раз при импорте
+_STOP_WORDS = frozenset({
+    'a', 'an', 'the', 'is', 'was', 'were', 'will', 'be', 'to', 'of', 'and',
+    'in', 'on', 'at', 'by', 'for', 'with', 'about', 'from', 'did', 'does',
+    'do', 'has', 'have', 'had', 'what', 'when', 'where', 'who', 'why', 'how',
+    'which', 'whose', 'whom', 'that'
+})
 
-def get_keywords(text: str, remove_stop_words: bool = True) -> Set[str]:
+def get_keywords(text: str, remove_stop_words: bool = True) -> FrozenSet[str]:
     """
-    Извлекает ключевые слова из текста
+    Извлекает ключевые слова из текста (кэшируется в nq_text.get_keywords)
     """
-    text = normalize_text(text)
-    words = text.split()
-    if remove_stop_words:
-        stop_words = get_stop_words()
-        words = [w for w in words if w not in stop_words]
-    return set(words)
+    return nq_text.get_keywords(text, _STOP_WORDS if remove_stop_words else frozenset())
 
-def calculate_similarity(keywords1: Set[str], keywords2: Set[str]) -> float:
+def get_keyword_ids(keywords: Set[str], keyword_to_id: Dict[str, int]) -> FrozenSet[int]:
     """
-    Вычисляет схожесть между двумя наборами ключевых слов
+    Переводит ключевые слова в их идентификаторы из словаря индекса
+    Слова, которых нет в словаре, пропускаются
     """
-    if not keywords1 or not keywords2:
-        return 0.0
+    return frozenset(keyword_to_id[k] for k in keywords if k in keyword_to_id)
+
+class KeywordIndex(NamedTuple):
+    """
+    Инвертированный индекс ключевых слов NQ
+    Списки вопросов хранятся в CSR-виде: вопросы по слову с идентификатором k
+    лежат в postings[postings_ptr[k]:postings_ptr[k + 1]], отсортированные по числу ключевых слов
+    """
+    keyword_to_id: Dict[str, int]
+    questions: List[Tuple[str, str, FrozenSet[int]]]  # qid -> (вопрос, URL, идентификаторы слов)
+    postings_ptr: Sequence[int]
+    postings: Sequence[int]
+    sizes: Sequence[int]  # qid -> число ключевых слов вопроса
+
+# Каталог, в котором сохраняется построенный индекс
+INDEX_DIR = 'nq_keyword_index'
+
+# Версия формата сохраненного индекса, индекс другой версии строится заново
+INDEX_VERSION = 3
+
+try:
+    from isal import igzip
+except ImportError:  # python-isal необязателен: без него распаковываем стандартным gzip
+    igzip = None
+
+# Размер буфера чтения распакованного потока
+GZIP_READ_BUFFER_SIZE = 128 * 1024
+
+def open_gzip(filepath: str):
+    """
+    Открывает gzip файл на чтение в бинарном режиме, через python-isal (ISA-L inflate),
+    если он установлен
+    Файлы и так распаковываются параллельно в разных процессах (см. process_nq_files),
+    поэтому многопоточная распаковка внутри файла не нужна
+    """
+    raw = igzip.open(filepath, 'rb') if igzip is not None else gzip.open(filepath, 'rb')
+    return io.BufferedReader(raw, buffer_size=GZIP_READ_BUFFER_SIZE)
+
+def read_nq_file(filepath: str) -> List[Tuple[int, str, str, FrozenSet[str]]]:
+    """
+    Читает один файл NQ датасета
+    Возвращает список (номер строки, вопрос, URL, ключевые слова)
+    Вызывается в отдельных процессах, поэтому не трогает общий индекс
+    """
+    records = []
     
-    intersection = len(keywords1 & keywords2)
-    union = len(keywords1 | keywords2)
+    with open_gzip(filepath) as f:
+        for i, line in enumerate(f, 1):
+            try:
+                question, url = parse_question_fields(line)
+                question = question.strip()
+                
+                if question:
+                    records.append((i, question, url, get_keywords(question)))
+            
+            except ValueError:  # ошибки разбора json, orjson и simdjson
+                continue
+            except Exception as e:
+                print(f"Error processing line: {str(e)}")
     
-    return intersection / union
+    return records
 
-def process_nq_files(file_paths: List[str], num_files: int = 3) -> Dict[str, List[Tuple[str, str, Set[str]]]]:
+def process_nq_files(file_paths: List[str], num_files: int = 3) -> KeywordIndex:
     """
-    Читает первые num_files файлов из NQ датасета
+    Читает первые num_files файлов из NQ датасета и строит индекс ключевых слов
+    Файлы разбираются параллельно, индекс собирается в порядке файлов
     """
     questions_by_keyword = defaultdict(list)
+    keyword_to_id = {}
+    questions = []
+    qid_by_question = {}  # вопрос -> qid, чтобы повторы хранились один раз
     total_processed = 0
     
     print(f"\nReading first {num_files} files from NQ dataset:")
     
-    for filepath in file_paths[:num_files]:
-        print(f"\nProcessing {filepath}:")
-        
-        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
-            for i, line in enumerate(f, 1):
-                try:
-                    data = json.loads(line.strip())
-                    question = data.get('question_text', '').strip()
-                    url = data.get('document_url', '')
+    file_paths = file_paths[:num_files]
+    max_workers = max(1, min(len(file_paths), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for filepath, records in zip(file_paths, executor.map(read_nq_file, file_paths)):
+            print(f"\nProcessing {filepath}:")
+            
+            for i, question, url, keywords in records:
+                # Вопрос хранится один раз, в списках по словам - только его номер
+                if question not in qid_by_question:
+                    for keyword in keywords:
+                        if keyword not in keyword_to_id:
+                            keyword_to_id[keyword] = len(keyword_to_id)
+                    keyword_ids = get_keyword_ids(keywords, keyword_to_id)
                     
-                    if question:
-                        keywords = get_keywords(question)
-                        
-                        # Для каждого ключевого слова сохраняем связь с вопросом
-                        for keyword in keywords:
-                            questions_by_keyword[keyword].append((question, url, keywords))
-                        
-                        total_processed += 1
-                        
-                        if i <= 5:
-                            print(f"Q{i}: {question}")
-                            print(f"Keywords: {keywords}")
-                            print(f"URL: {url}")
-                            print("---")
+                    qid = len(questions)
+                    qid_by_question[question] = qid
+                    # URL одной статьи Википедии повторяется у многих вопросов,
+                    # после интернирования все они ссылаются на одну строку
+                    questions.append((question, sys.intern(url), keyword_ids))
+                    for keyword_id in keyword_ids:
+                        questions_by_keyword[keyword_id].append(qid)
                 
-                except json.JSONDecodeError:
-                    continue
-                except Exception as e:
-                    print(f"Error processing line: {str(e)}")
+                total_processed += 1
+                
+                if i <= 5:
+                    print(f"Q{i}: {question}")
+                    print(f"Keywords: {set(keywords)}")
+                    print(f"URL: {url}")
+                    print("---")
+    
+    # Упаковываем списки вопросов в один плоский массив,
+    # внутри списка вопросы упорядочены по числу ключевых слов (см. find_matches)
+    sizes = array('H', (len(keyword_ids) for _, _, keyword_ids in questions))
+    postings_ptr = array('Q', [0])
+    postings = array('I')
+    for keyword_id in range(len(keyword_to_id)):
+        postings.extend(sorted(questions_by_keyword[keyword_id], key=sizes.__getitem__))
+        postings_ptr.append(len(postings))
     
     print(f"\nTotal questions processed: {total_processed}")
-    print(f"Total unique keywords: {len(questions_by_keyword)}")
-    return questions_by_keyword
+    print(f"Total unique keywords: {len(keyword_to_id)}")
+    return KeywordIndex(keyword_to_id, questions, postings_ptr, postings, sizes)
+
+def file_signatures(file_paths: List[str]) -> List[list]:
+    """
+    Отпечатки исходных файлов: [путь, mtime в наносекундах, размер]
+    Измененный или замененный файл дает другой отпечаток, и индекс строится заново
+    """
+    signatures = []
+    for path in file_paths:
+        stat = os.stat(path)
+        signatures.append([path, stat.st_mtime_ns, stat.st_size])
+    return signatures
+
+def save_index(index: KeywordIndex, index_dir: str, file_paths: List[str]):
+    """
+    Сохраняет индекс на диск:
+    meta.json - отпечатки исходных файлов, keywords.json - слова в порядке идентификаторов,
+    questions.jsonl - таблица вопросов, postings_ptr.u64/postings.u32 - списки вопросов
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    
+    keywords = sorted(index.keyword_to_id, key=index.keyword_to_id.get)
+    with open(os.path.join(index_dir, 'keywords.json'), 'w', encoding='utf-8') as f:
+        json.dump(keywords, f, ensure_ascii=False)
+    
+    with open(os.path.join(index_dir, 'questions.jsonl'), 'w', encoding='utf-8') as f:
+        for question, url, keyword_ids in index.questions:
+            f.write(json.dumps([question, url, sorted(keyword_ids)], ensure_ascii=False) + '\n')
+    
+    with open(os.path.join(index_dir, 'postings_ptr.u64'), 'wb') as f:
+        index.postings_ptr.tofile(f)
+    with open(os.path.join(index_dir, 'postings.u32'), 'wb') as f:
+        index.postings.tofile(f)
+    
+    # meta.json пишется последним: его наличие означает, что индекс сохранен полностью
+    with open(os.path.join(index_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'version': INDEX_VERSION, 'files': file_signatures(file_paths)}, f, ensure_ascii=False)
+
+def load_index(index_dir: str, file_paths: List[str]) -> Optional[KeywordIndex]:
+    """
+    Загружает сохраненный индекс, если он построен по тем же, не измененным с тех пор файлам
+    Списки вопросов не читаются в память, а отображаются через mmap
+    """
+    try:
+        with open(os.path.join(index_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        files = file_signatures(file_paths)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if meta.get('version') != INDEX_VERSION or meta.get('files') != files:
+        return None
+    
+    with open(os.path.join(index_dir, 'keywords.json'), 'r', encoding='utf-8') as f:
+        keyword_to_id = {keyword: i for i, keyword in enumerate(json.load(f))}
+    
+    questions = []
+    with open(os.path.join(index_dir, 'questions.jsonl'), 'rb') as f:
+        for line in f:
+            question, url, keyword_ids = json_loads(line)
+            questions.append((question, sys.intern(url), frozenset(keyword_ids)))
+    
+    postings_ptr = array('Q')
+    with open(os.path.join(index_dir, 'postings_ptr.u64'), 'rb') as f:
+        postings_ptr.frombytes(f.read())
+    
+    postings_path = os.path.join(index_dir, 'postings.u32')
+    if os.path.getsize(postings_path):
+        with open(postings_path, 'rb') as f:
+            postings = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast('I')
+    else:
+        postings = array('I')
+    
+    sizes = array('H', (len(keyword_ids) for _, _, keyword_ids in questions))
+    
+    print(f"\nLoaded keyword index from {index_dir}: "
+          f"{len(questions)} questions, {len(keyword_to_id)} keywords")
+    return KeywordIndex(keyword_to_id, questions, postings_ptr, postings, sizes)
 
 def find_matches(
     target_question: str,
-    questions_by_keyword: Dict[str, List[Tuple[str, str, Set[str]]]],
+    index: KeywordIndex,
     threshold: float = 0.3
 ) -> List[Tuple[str, str, float]]:
     """
     Ищет похожие вопросы
     """
     target_keywords = get_keywords(target_question)
-    candidates = {}  # question -> (url, similarity)
+    target_ids = get_keyword_ids(target_keywords, index.keyword_to_id)
+    target_size = len(target_keywords)
     
-    # Собираем кандидатов по каждому ключевому слову
-    for keyword in target_keywords:
-        if keyword in questions_by_keyword:
-            for q, url, keywords in questions_by_keyword[keyword]:
-                similarity = calculate_similarity(target_keywords, keywords)
-                if similarity >= threshold:
-                    if q not in candidates or candidates[q][1] < similarity:
-                        candidates[q] = (url, similarity)
+    # Жаккар не меньше threshold только у вопросов, где число ключевых слов
+    # лежит в [threshold * K, K / threshold]; запас 1e-9 защищает от ошибок округления
+    if threshold > 0:
+        min_size = math.ceil(threshold * target_size - 1e-9)
+        max_size = math.floor(target_size / threshold + 1e-9)
+    else:
+        min_size, max_size = 0, math.inf
+    
+    # Собираем кандидатов по каждому ключевому слову, из отсортированного
+    # по размеру списка берем только подходящий диапазон
+    # Вопрос встречается в списке каждого общего слова ровно один раз,
+    # поэтому счетчик вхождений и есть размер пересечения |A & B|
+    intersections = Counter()
+    for keyword_id in target_ids:
+        postings = index.postings[index.postings_ptr[keyword_id]:index.postings_ptr[keyword_id + 1]]
+        lo = bisect_left(postings, min_size, key=index.sizes.__getitem__)
+        hi = bisect_right(postings, max_size, lo=lo, key=index.sizes.__getitem__)
+        intersections.update(postings[lo:hi])
+    
+    # Коэффициент Жаккара: |A & B| / (|A| + |B| - |A & B|),
+    # |A| включает слова цели, которых нет в словаре
+    results = []
+    for qid, intersection in intersections.items():
+        similarity = intersection / (target_size + index.sizes[qid] - intersection)
+        if similarity >= threshold:
+            q, url, _ = index.questions[qid]
+            results.append((q, url, similarity))
     
     # Сортируем результаты по убыванию схожести
-    results = [(q, url, sim) for q, (url, sim) in candidates.items()]
     return sorted(results, key=lambda x: x[2], reverse=True)
 
 def process_efficient_qa(
-    questions_by_keyword: Dict[str, List[Tuple[str, str, Set[str]]]],
+    index: KeywordIndex,
     num_questions: int = 50
 ):
     """
@@ -133,37 +339,42 @@ def process_efficient_qa(
     print("\nEfficient QA Dataset questions:")
     print("-" * 80)
     
-    with open(filepath, 'r', encoding='utf-8') as f:
+    with open(filepath, 'rb') as f:
         for i, line in enumerate(f):
             if i >= num_questions:
                 break
                 
+            # Вывод по вопросу собирается и печатается одним вызовом print
+            lines = []
             try:
-                data = json.loads(line.strip())
+                data = json_loads(line)
                 question = data.get('question', '').strip()
                 answer = data.get('answer', [''])[0]
                 
-                print(f"\nQ{i+1}: {question}")
-                print(f"Answer: {answer}")
+                lines.append(f"\nQ{i+1}: {question}")
+                lines.append(f"Answer: {answer}")
                 
                 # Ищем похожие вопросы
-                similar = find_matches(question, questions_by_keyword)
+                similar = find_matches(question, index)
                 
                 if similar:
                     matches_found.append((question, similar[:3]))  # сохраняем топ-3 совпадения
-                    print("Matches found:")
+                    lines.append("Matches found:")
                     for j, (nq_q, url, sim) in enumerate(similar[:3], 1):
-                        print(f"  {j}. Similarity: {sim:.2f}")
-                        print(f"     NQ: {nq_q}")
-                        print(f"     URL: {url}")
+                        lines.append(f"  {j}. Similarity: {sim:.2f}")
+                        lines.append(f"     NQ: {nq_q}")
+                        lines.append(f"     URL: {url}")
                 else:
                     questions_without_matches.append(question)
-                    print("No matches found")
+                    lines.append("No matches found")
                 
             except json.JSONDecodeError:
                 continue
             except Exception as e:
-                print(f"Error processing line: {str(e)}")
+                lines.append(f"Error processing line: {str(e)}")
+            finally:
+                if lines:
+                    print('\n'.join(lines))
     
     return matches_found, questions_without_matches
 
@@ -183,11 +394,14 @@ def main():
                        if f.endswith('.jsonl.gz')])
     nq_files.extend(dev_files[:1])  # Берем первый файл из dev
     
-    # Читаем NQ датасет
-    questions_by_keyword = process_nq_files(nq_files)
+    # Загружаем сохраненный индекс или строим его по NQ датасету
+    index = load_index(INDEX_DIR, nq_files)
+    if index is None:
+        index = process_nq_files(nq_files)
+        save_index(index, INDEX_DIR, nq_files)
     
     # Обрабатываем efficient_qa
-    matches, no_matches = process_efficient_qa(questions_by_keyword)
+    matches, no_matches = process_efficient_qa(index)
     
     # Выводим статистику
     print("\nResults:")
@@ -207,7 +421,7 @@ def main():
         print("\nExample questions without matches:")
         for q in no_matches[:5]:
             print(f"- {q}")
-            print(f"  Keywords: {get_keywords(q)}")
+            print(f"  Keywords: {set(get_keywords(q))}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
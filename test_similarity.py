@@ -1,37 +1,15 @@
-import json
 from typing import Set
-import string
-import re
+import nq_text
+from nq_text import calculate_similarity
 
-def normalize_text(text: str) -> str:
-    """
-    Базовая нормализация текста
-    """
-    text = text.lower().strip()
-    text = re.sub(f'[{string.punctuation}]', ' ', text)
-    text = ' '.join(text.split())
-    return text
+# Стоп-слова, строятся один раз при импорте
+_STOP_WORDS = frozenset({'a', 'an', 'the', 'is', 'was', 'were', 'will', 'be', 'in', 'on', 'at', 'to', 'for', 'of'})
 
 def get_keywords(text: str) -> Set[str]:
     """
     Извлекает ключевые слова из текста
     """
-    text = normalize_text(text)
-    stop_words = {'a', 'an', 'the', 'is', 'was', 'were', 'will', 'be', 'in', 'on', 'at', 'to', 'for', 'of'}
-    words = [w for w in text.split() if w not in stop_words]
-    return set(words)
-
-def calculate_similarity(keywords1: Set[str], keywords2: Set[str]) -> float:
-    """
-    Вычисляет схожесть между двумя наборами ключевых слов
-    """
-    if not keywords1 or not keywords2:
-        return 0.0
-    
-    intersection = len(keywords1 & keywords2)
-    union = len(keywords1 | keywords2)
-    
-    return intersection / union
+    return set(nq_text.get_keywords(text, _STOP_WORDS))
 
 def test_similarity(q1: str, q2: str):
     """